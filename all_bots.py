@@ -1,10 +1,27 @@
 import threading
 import os
 import sys
+import time
 from dotenv import load_dotenv
-import yt_dlp
 import asyncio
 
+# --- Startup timing ---
+startup_started = time.perf_counter()
+startup_timings = []  # (phase, seconds) in the order the phases finished
+
+def record_startup_phase(phase, started):
+    # Records the phase and returns a fresh start mark for the next one
+    now = time.perf_counter()
+    startup_timings.append((phase, now - started))
+    return now
+
+def print_startup_timings():
+    print("⏱️ Startup timing:")
+    for phase, seconds in startup_timings:
+        print(f"   {phase}: {seconds * 1000:.0f} ms")
+    print(f"   total: {(time.perf_counter() - startup_started) * 1000:.0f} ms")
+
+phase_started = startup_started
 last_ticketboard_message = None
 load_dotenv()
 
@@ -22,77 +39,253 @@ if missing_tokens:
     print(f"❌ Missing required environment variables: {', '.join(missing_tokens)}")
     print("Please create a .env file with all required bot tokens.")
     sys.exit(1)
+phase_started = record_startup_phase("environment", phase_started)
 
-# Validate voice dependencies
-try:
-    import nacl
-    print("✅ PyNaCl is installed")
-except ImportError:
-    print("❌ PyNaCl is not installed. Please run: pip install PyNaCl")
-    print("Voice functionality will not work without PyNaCl.")
-    sys.exit(1)
-
-# Check for FFmpeg
-try:
-    import subprocess
-    result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-    if result.returncode == 0:
-        print("✅ FFmpeg is available")
-    else:
-        print("⚠️  FFmpeg not found. Voice functionality may not work properly.")
-        print("Please install FFmpeg: https://ffmpeg.org/download.html")
-except FileNotFoundError:
-    print("⚠️  FFmpeg not found. Voice functionality may not work properly.")
-    print("Please install FFmpeg: https://ffmpeg.org/download.html")
+# Voice dependencies (PyNaCl, FFmpeg) and yt_dlp are only needed by the music
+# bot, so they are checked and imported when it starts; see prepare_music_environment.
 
 import discord as discord_app
 from discord.ext import commands as commands_app
 from discord.ui import Button as Button_app, View as View_app
 import asyncio as asyncio_app
+phase_started = record_startup_phase("discord import", phase_started)
 
 import sqlite3
+import queue
+import time
+import atexit
+import concurrent.futures
+from collections import OrderedDict
+
+# ================== Async Storage ==================
+# Each database is owned by one writer thread that holds the only connection.
+# Coroutines submit jobs through a queue and await the result, so gateway
+# handlers never block on SQLite or on a commit's fsync. Jobs that queue up
+# while a commit is running are executed together and share the next commit.
+all_databases = []
+
+class AsyncDatabase:
+    def __init__(self, path, schema=()):
+        self.path = path
+        # Time the writer thread spent executing and committing, for benchmarks and stats
+        self.busy_seconds = 0.0
+        self.jobs_done = 0
+        self.batches = 0
+        self._jobs = queue.SimpleQueue()
+        self._ready = threading.Event()
+        self._setup_error = None
+        self._thread = threading.Thread(target=self._worker, args=(list(schema),), name=f"sqlite:{path}", daemon=True)
+        self._thread.start()
+        # Schema problems (a locked or unreadable file) fail loudly here, at
+        # import, rather than leaving every later await hanging
+        self._ready.wait()
+        if self._setup_error is not None:
+            raise RuntimeError(f"Could not open database {path}: {self._setup_error}") from self._setup_error
+        all_databases.append(self)
+
+    def _setup(self, schema):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        for statement in schema:
+            conn.execute(statement)
+        return conn
+
+    def _worker(self, schema):
+        try:
+            conn = self._setup(schema)
+        except Exception as e:
+            self._setup_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        running = True
+        while running:
+            batch = [self._jobs.get()]
+            while True:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [job for job in batch if job is not None]
+            try:
+                self._run_batch(conn, batch)
+            except Exception as e:
+                # BEGIN, RELEASE/ROLLBACK TO or COMMIT itself failed (disk full,
+                # I/O error, a lock that outlived busy_timeout): fail this batch
+                # and keep serving the next one
+                print(f"⚠️ {self.path}: batch of {len(batch)} job(s) failed: {e}")
+                if conn.in_transaction:
+                    try:
+                        conn.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        pass
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+        conn.close()
+
+    def _run_batch(self, conn, batch):
+        results = []
+        batch_started = time.perf_counter()
+        conn.execute('BEGIN')
+        for fn, args, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            # A savepoint per job so one failing job does not undo its neighbours
+            conn.execute('SAVEPOINT job')
+            try:
+                results.append((future, fn(conn, *args), None))
+                conn.execute('RELEASE job')
+            except Exception as e:
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                results.append((future, None, e))
+        conn.execute('COMMIT')
+        self.busy_seconds += time.perf_counter() - batch_started
+        self.jobs_done += len(results)
+        self.batches += 1
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def submit(self, fn, *args):
+        # Thread-safe: returns a concurrent future resolved once the job is committed
+        future = concurrent.futures.Future()
+        self._jobs.put((fn, args, future))
+        return future
+
+    async def run(self, fn, *args):
+        # fn(conn, *args) runs on the writer thread inside the batch transaction
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    async def execute(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).lastrowid)
+
+    async def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+
+def close_all_databases():
+    for db in all_databases:
+        db.close()
+
+atexit.register(close_all_databases)
+
+# ================== User Name Resolver ==================
+# Turns user IDs into User/Member objects for leaderboards: gateway member cache
+# first, then a small LRU with a TTL, and only then REST, with the misses fetched
+# concurrently (bounded so a big board cannot burst the rate limit).
+NAME_CACHE_SIZE = 2048
+NAME_CACHE_TTL = 3600  # Seconds a fetched user is trusted before it is fetched again
+NAME_FETCH_CONCURRENCY = 5
+
+class UserNameResolver:
+    def __init__(self, bot, cache_size=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL, concurrency=NAME_FETCH_CONCURRENCY):
+        self.bot = bot
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.cache = OrderedDict()  # user_id -> (expires_at, user or None)
+        self._semaphore = None
+
+    def _cached(self, user_id, now):
+        entry = self.cache.get(user_id)
+        if entry is None:
+            return False, None
+        if entry[0] <= now:
+            del self.cache[user_id]
+            return False, None
+        self.cache.move_to_end(user_id)
+        return True, entry[1]
+
+    def _store(self, user_id, user):
+        self.cache[user_id] = (time.monotonic() + self.ttl, user)
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def _fetch(self, user_id):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord_app.NotFound:
+                user = None  # Deleted account, remember that too
+            except discord_app.HTTPException:
+                return None
+        self._store(user_id, user)
+        return user
+
+    async def resolve(self, user_ids, guild=None):
+        # Returns {user_id: User/Member or None}
+        now = time.monotonic()
+        resolved = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            user = (guild.get_member(user_id) if guild else None) or self.bot.get_user(user_id)
+            if user is None:
+                hit, user = self._cached(user_id, now)
+                if not hit:
+                    missing.append(user_id)
+                    continue
+            resolved[user_id] = user
+        if missing:
+            fetched = await asyncio.gather(*(self._fetch(user_id) for user_id in missing))
+            resolved.update(zip(missing, fetched))
+        return resolved
+
 # --- SQLite setup for Application Bot ---
-app_db_lock = threading.Lock()
-app_db = sqlite3.connect('applicationbot.db', check_same_thread=False)
-app_db.row_factory = sqlite3.Row
-app_cursor = app_db.cursor()
-app_cursor.execute('''
-CREATE TABLE IF NOT EXISTS app_counter (
-    app_type TEXT PRIMARY KEY,
-    counter INTEGER NOT NULL
-)
-''')
-app_cursor.execute('''
-CREATE TABLE IF NOT EXISTS applications (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    app_type TEXT NOT NULL,
-    channel_id INTEGER NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-''')
-# Initialize counters if not present
-for t in ("astdx", "als", "all"):
-    if not app_cursor.execute('SELECT 1 FROM app_counter WHERE app_type = ?', (t,)).fetchone():
-        app_cursor.execute('INSERT INTO app_counter (app_type, counter) VALUES (?, ?)', (t, 1))
-app_db.commit()
-
-def get_app_counter(app_type):
-    with app_db_lock:
-        row = app_cursor.execute('SELECT counter FROM app_counter WHERE app_type = ?', (app_type,)).fetchone()
-        return row['counter'] if row else 1
-
-def increment_app_counter(app_type):
-    with app_db_lock:
-        c = get_app_counter(app_type)
-        app_cursor.execute('UPDATE app_counter SET counter = ? WHERE app_type = ?', (c+1, app_type))
-        app_db.commit()
-        return c
-
-def log_application(user_id, app_type, channel_id):
-    with app_db_lock:
-        app_cursor.execute('INSERT INTO applications (user_id, app_type, channel_id) VALUES (?, ?, ?)', (user_id, app_type, channel_id))
-        app_db.commit()
+app_db = AsyncDatabase('applicationbot.db', schema=[
+    '''
+    CREATE TABLE IF NOT EXISTS app_counter (
+        app_type TEXT PRIMARY KEY,
+        counter INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS applications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        app_type TEXT NOT NULL,
+        channel_id INTEGER NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Initialize counters if not present
+    "INSERT OR IGNORE INTO app_counter (app_type, counter) VALUES ('astdx', 1), ('als', 1), ('all', 1)",
+])
+
+async def increment_app_counter(app_type):
+    # A single upsert allocates the number; the writer thread orders concurrent presses
+    rows = await app_db.fetchall(
+        'INSERT INTO app_counter (app_type, counter) VALUES (?, 2) '
+        'ON CONFLICT(app_type) DO UPDATE SET counter = counter + 1 '
+        'RETURNING counter - 1',
+        (app_type,)
+    )
+    return rows[0][0]
+
+async def log_application(user_id, app_type, channel_id):
+    await app_db.execute('INSERT INTO applications (user_id, app_type, channel_id) VALUES (?, ?, ?)', (user_id, app_type, channel_id))
 
 intents_app = discord_app.Intents.all()
 bot_app = commands_app.Bot(command_prefix="app!", intents=intents_app)
@@ -137,7 +330,7 @@ class ApplicationButton(Button_app):
         user = interaction.user
         guild = interaction.guild
         category = guild.get_channel(CATEGORY_ID)
-        number = increment_app_counter(self.app_type)
+        number = await increment_app_counter(self.app_type)
         channel_name = f"{self.app_type}-application-#{number:04}"
         overwrites = {
             guild.default_role: discord_app.PermissionOverwrite(read_messages=False),
@@ -148,7 +341,7 @@ class ApplicationButton(Button_app):
             category=category,
             overwrites=overwrites
         )
-        log_application(user.id, self.app_type, channel.id)
+        await log_application(user.id, self.app_type, channel.id)
         await interaction.response.send_message(f"\u2705 Application created: {channel.mention}", ephemeral=True)
         await channel.send(f"{user.mention}\n{form_message}")
         view = View_app()
@@ -201,14 +394,14 @@ class DeleteTicketButton(Button_app):
     async def callback(self, interaction: discord_app.Interaction):
         await interaction.response.send_message("This ticket will be deleted in 5 seconds...", ephemeral=True)
         await asyncio_app.sleep(5)
-        ticket_data = get_ticket(interaction.channel.id)
+        ticket_data = await get_ticket(interaction.channel.id)
         if not ticket_data:
             await interaction.response.send_message("\u274c This ticket does not exist or is already closed.", ephemeral=True)
             return
         if interaction.user.id != ticket_data['creator_id']:
             await interaction.response.send_message("\u274c Only the ticket creator can delete this ticket.", ephemeral=True)
             return
-        delete_ticket(interaction.channel.id)
+        await delete_ticket(interaction.channel.id)
         await interaction.response.send_message("\ud83d\uddd1\ufe0f Ticket deleted.", ephemeral=True)
         await interaction.channel.delete()
         staff_id = ticket_data['staff_id']
@@ -333,23 +526,96 @@ from discord.ext import commands as commands_give, tasks as tasks_give
 import asyncio as asyncio_give
 import random as random_give
 from datetime import datetime as datetime_give, timedelta as timedelta_give
+from collections import OrderedDict as OrderedDict_give
 
-import sqlite3
 # --- SQLite setup for Level Bot ---
-level_db_lock = threading.Lock()
-
-# Update SQLite connection for thread safety
-level_db = sqlite3.connect('levelbot.db', check_same_thread=False)
-level_db.row_factory = sqlite3.Row
-level_cursor = level_db.cursor()
-level_cursor.execute('''
-CREATE TABLE IF NOT EXISTS user_exp (
-    user_id INTEGER PRIMARY KEY,
-    exp INTEGER NOT NULL,
-    level INTEGER NOT NULL
-)
-''')
-level_db.commit()
+level_db = AsyncDatabase('levelbot.db', schema=[
+    '''
+    CREATE TABLE IF NOT EXISTS user_exp (
+        user_id INTEGER PRIMARY KEY,
+        exp INTEGER NOT NULL,
+        level INTEGER NOT NULL
+    )
+    ''',
+    # Covers leaderboard pages and rank counts without touching the table
+    'CREATE INDEX IF NOT EXISTS idx_user_exp_rank ON user_exp (level, exp, user_id)',
+    # Users per level, kept in step with user_exp by the triggers below
+    '''
+    CREATE TABLE IF NOT EXISTS level_population (
+        level INTEGER PRIMARY KEY,
+        users INTEGER NOT NULL
+    )
+    ''',
+    # Backfill once for databases created before level_population existed
+    '''
+    INSERT INTO level_population (level, users)
+    SELECT level, COUNT(*) FROM user_exp
+    WHERE NOT EXISTS (SELECT 1 FROM level_population)
+    GROUP BY level
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_exp_population_insert AFTER INSERT ON user_exp
+    BEGIN
+        INSERT INTO level_population (level, users) VALUES (NEW.level, 1)
+        ON CONFLICT(level) DO UPDATE SET users = users + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_exp_population_update AFTER UPDATE OF level ON user_exp
+    WHEN OLD.level != NEW.level
+    BEGIN
+        UPDATE level_population SET users = users - 1 WHERE level = OLD.level;
+        INSERT INTO level_population (level, users) VALUES (NEW.level, 1)
+        ON CONFLICT(level) DO UPDATE SET users = users + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_exp_population_delete AFTER DELETE ON user_exp
+    BEGIN
+        UPDATE level_population SET users = users - 1 WHERE level = OLD.level;
+    END
+    ''',
+    # Users per (level, exp), so counting who is ahead within a level reads at
+    # most one row per EXP value instead of one per user. Empty rows are removed.
+    '''
+    CREATE TABLE IF NOT EXISTS exp_population (
+        level INTEGER NOT NULL,
+        exp INTEGER NOT NULL,
+        users INTEGER NOT NULL,
+        PRIMARY KEY (level, exp)
+    )
+    ''',
+    '''
+    INSERT INTO exp_population (level, exp, users)
+    SELECT level, exp, COUNT(*) FROM user_exp
+    WHERE NOT EXISTS (SELECT 1 FROM exp_population)
+    GROUP BY level, exp
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_exp_exp_population_insert AFTER INSERT ON user_exp
+    BEGIN
+        INSERT INTO exp_population (level, exp, users) VALUES (NEW.level, NEW.exp, 1)
+        ON CONFLICT(level, exp) DO UPDATE SET users = users + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_exp_exp_population_update AFTER UPDATE OF level, exp ON user_exp
+    WHEN OLD.level != NEW.level OR OLD.exp != NEW.exp
+    BEGIN
+        UPDATE exp_population SET users = users - 1 WHERE level = OLD.level AND exp = OLD.exp;
+        DELETE FROM exp_population WHERE level = OLD.level AND exp = OLD.exp AND users <= 0;
+        INSERT INTO exp_population (level, exp, users) VALUES (NEW.level, NEW.exp, 1)
+        ON CONFLICT(level, exp) DO UPDATE SET users = users + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_exp_exp_population_delete AFTER DELETE ON user_exp
+    BEGIN
+        UPDATE exp_population SET users = users - 1 WHERE level = OLD.level AND exp = OLD.exp;
+        DELETE FROM exp_population WHERE level = OLD.level AND exp = OLD.exp AND users <= 0;
+    END
+    ''',
+])
 
 intents_give = discord_give.Intents.default()
 intents_give.message_content = True
@@ -357,57 +623,298 @@ intents_give.members = True
 bot_give = commands_give.Bot(command_prefix='mul!', intents=intents_give)
 
 bot_give.remove_command('help')
+give_names = UserNameResolver(bot_give)
 
 # --- SQLite helper functions for user EXP/level ---
-def get_user_exp(user_id):
-    with level_db_lock:
-        row = level_cursor.execute('SELECT exp, level FROM user_exp WHERE user_id = ?', (user_id,)).fetchone()
-        if row:
-            return {'exp': row['exp'], 'level': row['level']}
-        else:
-            return {'exp': 0, 'level': 1}
+async def get_user_exp(user_id):
+    row = await level_db.fetchone('SELECT exp, level FROM user_exp WHERE user_id = ?', (user_id,))
+    if row:
+        return {'exp': row['exp'], 'level': row['level']}
+    else:
+        return {'exp': 0, 'level': 1}
 
-def set_user_exp(user_id, exp, level):
-    with level_db_lock:
-        if level_cursor.execute('SELECT 1 FROM user_exp WHERE user_id = ?', (user_id,)).fetchone():
-            level_cursor.execute('UPDATE user_exp SET exp = ?, level = ? WHERE user_id = ?', (exp, level, user_id))
-        else:
-            level_cursor.execute('INSERT INTO user_exp (user_id, exp, level) VALUES (?, ?, ?)', (user_id, exp, level))
-        level_db.commit()
+async def set_user_exp(user_id, exp, level):
+    await level_db.execute(
+        'INSERT INTO user_exp (user_id, exp, level) VALUES (?, ?, ?) '
+        'ON CONFLICT(user_id) DO UPDATE SET exp = excluded.exp, level = excluded.level',
+        (user_id, exp, level)
+    )
 
 def get_required_exp(level):
     return 3 * (2 ** (level - 1))
 
+# --- Write-behind EXP buffer ---
+# on_message only touches memory; changed users are written to user_exp in one
+# batched transaction every EXP_FLUSH_INTERVAL seconds or once EXP_FLUSH_BATCH
+# users are pending, and whatever is left is drained at exit.
+EXP_FLUSH_INTERVAL = 2.0
+EXP_FLUSH_BATCH = 200
+EXP_CACHE_SIZE = 10000  # Clean (already saved) users kept in memory
+
+class ExpAccumulator:
+    def __init__(self, db, flush_batch=EXP_FLUSH_BATCH, cache_size=EXP_CACHE_SIZE):
+        self.db = db
+        self.flush_batch = flush_batch
+        self.cache_size = cache_size
+        self.states = OrderedDict_give()  # user_id -> {'exp', 'level'}, least recently used first
+        self.dirty = set()
+        self._flush_task = None
+
+    async def get(self, user_id):
+        state = self.states.get(user_id)
+        if state is None:
+            loaded = await get_user_exp(user_id)
+            # Another message from this user may have loaded it while we awaited
+            state = self.states.setdefault(user_id, loaded)
+        self.states.move_to_end(user_id)
+        return state
+
+    async def add_exp(self, user_id, amount=1):
+        # Returns (state, leveled_up); level-ups are computed here so announcements stay immediate
+        state = await self.get(user_id)
+        state['exp'] += amount
+        leveled_up = False
+        while state['exp'] >= get_required_exp(state['level']):
+            state['exp'] -= get_required_exp(state['level'])
+            state['level'] += 1
+            leveled_up = True
+        self.dirty.add(user_id)
+        if len(self.dirty) >= self.flush_batch and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio_give.create_task(self.flush())
+        return state, leveled_up
+
+    def _take_dirty_rows(self):
+        rows = [(user_id, self.states[user_id]['exp'], self.states[user_id]['level']) for user_id in self.dirty]
+        self.dirty.clear()
+        return rows
+
+    def _evict_clean(self):
+        for user_id in list(self.states):
+            if len(self.states) <= self.cache_size:
+                break
+            if user_id not in self.dirty:
+                del self.states[user_id]
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        rows = self._take_dirty_rows()
+        # Submitted before the first await, so a drain at exit can never miss these rows
+        future = self.db.submit(_write_exp_rows, rows)
+        try:
+            await asyncio_give.wrap_future(future)
+        except Exception as e:
+            print(f"❌ Failed to save EXP for {len(rows)} users: {e}")
+            self.dirty.update(user_id for user_id, _, _ in rows)
+            return
+        self._evict_clean()
+
+    def drain(self):
+        # Synchronous final flush for shutdown, runs before the databases close
+        if self.dirty:
+            self.db.submit(_write_exp_rows, self._take_dirty_rows()).result()
+
+def _write_exp_rows(conn, rows):
+    conn.executemany(
+        'INSERT INTO user_exp (user_id, exp, level) VALUES (?, ?, ?) '
+        'ON CONFLICT(user_id) DO UPDATE SET exp = excluded.exp, level = excluded.level',
+        rows
+    )
+
+exp_buffer = ExpAccumulator(level_db)
+atexit.register(exp_buffer.drain)
+
+@tasks_give.loop(seconds=EXP_FLUSH_INTERVAL)
+async def flush_exp_buffer():
+    await exp_buffer.flush()
+
+@flush_exp_buffer.after_loop
+async def drain_exp_buffer():
+    await exp_buffer.flush()
+
+@bot_give.event
+async def on_ready():
+    print(f"bot_give is online! Username: {bot_give.user} (ID: {bot_give.user.id})")
+    if not flush_exp_buffer.is_running():
+        flush_exp_buffer.start()
+
 @bot_give.event
 async def on_message(message):
     if message.author.bot:
         return
-    user_id = message.author.id
-    user_data = get_user_exp(user_id)
-    user_data['exp'] += 1
-    leveled_up = False
-    while user_data['exp'] >= get_required_exp(user_data['level']):
-        user_data['exp'] -= get_required_exp(user_data['level'])
-        user_data['level'] += 1
-        leveled_up = True
-    set_user_exp(user_id, user_data['exp'], user_data['level'])
+    user_data, leveled_up = await exp_buffer.add_exp(message.author.id)
     if leveled_up:
         await message.channel.send(f"\ud83c\udf89 {message.author.mention} leveled up to level {user_data['level']}!")
     await bot_give.process_commands(message)
 @bot_give.command(name='check')
 async def check_level(ctx):
-    user = get_user_exp(ctx.author.id)
+    user = await exp_buffer.get(ctx.author.id)
     await ctx.send(f"{ctx.author.mention}, Level: {user['level']}, EXP: {user['exp']} / {get_required_exp(user['level'])}")
-@bot_give.command(name='lb')
-async def leaderboard(ctx):
-    with level_db_lock:
-        sorted_users = level_cursor.execute('SELECT user_id, exp, level FROM user_exp ORDER BY level DESC, exp DESC LIMIT 10').fetchall()
+# --- Rank lookup and paginated leaderboard ---
+# Ranks never count users: everyone in a higher level comes from
+# level_population (a handful of rows) and everyone ahead within the level
+# from exp_population, which has at most one row per EXP value that level can
+# hold. Tied users share a rank, on mul!rank and mul!lb alike. The Previous and
+# Next buttons seek from the last (level, exp, user_id) shown; mul!lb <page>
+# finds its first row by walking the same population tables, so only the
+# users tied on that row's (level, exp) are stepped over one by one.
+LEADERBOARD_PAGE_SIZE = 10
+
+def _rank_of(conn, level, exp):
+    above = conn.execute('SELECT COALESCE(SUM(users), 0) FROM level_population WHERE level > ?', (level,)).fetchone()[0]
+    ahead = conn.execute('SELECT COALESCE(SUM(users), 0) FROM exp_population WHERE level = ? AND exp > ?', (level, exp)).fetchone()[0]
+    return above + ahead + 1
+
+def _get_user_rank(conn, user_id):
+    row = conn.execute('SELECT exp, level FROM user_exp WHERE user_id = ?', (user_id,)).fetchone()
+    if not row:
+        return None
+    total = conn.execute('SELECT COALESCE(SUM(users), 0) FROM level_population').fetchone()[0]
+    return {'rank': _rank_of(conn, row['level'], row['exp']), 'total': total, 'exp': row['exp'], 'level': row['level']}
+
+def _get_ranks(conn, keys):
+    return {key: _rank_of(conn, *key) for key in keys}
+
+async def get_leaderboard_ranks(rows):
+    # {(level, exp): rank} for the rows on one page
+    return await level_db.run(_get_ranks, list(dict.fromkeys((row['level'], row['exp']) for row in rows)))
+
+async def get_user_rank(user_id):
+    await exp_buffer.flush()
+    return await level_db.run(_get_user_rank, user_id)
+
+async def get_tracked_user_count():
+    row = await level_db.fetchone('SELECT COALESCE(SUM(users), 0) FROM level_population')
+    return row[0]
+
+async def fetch_leaderboard_page(after=None, before=None, per_page=LEADERBOARD_PAGE_SIZE):
+    # after/before are (level, exp, user_id) keys; rows always come back best first
+    sql = 'SELECT user_id, exp, level FROM user_exp'
+    params = []
+    order = 'DESC'
+    if after is not None:
+        sql += ' WHERE (level, exp, user_id) < (?, ?, ?)'
+        params.extend(after)
+    elif before is not None:
+        sql += ' WHERE (level, exp, user_id) > (?, ?, ?)'
+        params.extend(before)
+        order = 'ASC'
+    sql += f' ORDER BY level {order}, exp {order}, user_id {order} LIMIT ?'
+    params.append(per_page)
+    rows = await level_db.fetchall(sql, params)
+    if order == 'ASC':
+        rows.reverse()
+    return rows
+
+def _leaderboard_rows_from(conn, position, per_page):
+    # Rows from the given 0-based position on, without OFFSET over the table
+    for level, users in conn.execute('SELECT level, users FROM level_population WHERE users > 0 ORDER BY level DESC').fetchall():
+        if position < users:
+            break
+        position -= users
+    else:
+        return []
+    for exp, users in conn.execute(
+        'SELECT exp, users FROM exp_population WHERE level = ? ORDER BY exp DESC', (level,)
+    ).fetchall():
+        if position < users:
+            break
+        position -= users
+    else:
+        return []
+    first = conn.execute(
+        'SELECT user_id FROM user_exp WHERE level = ? AND exp = ? ORDER BY user_id DESC LIMIT 1 OFFSET ?', (level, exp, position)
+    ).fetchone()
+    if first is None:
+        return []
+    return conn.execute(
+        'SELECT user_id, exp, level FROM user_exp WHERE (level, exp, user_id) <= (?, ?, ?) '
+        'ORDER BY level DESC, exp DESC, user_id DESC LIMIT ?',
+        (level, exp, first['user_id'], per_page)
+    ).fetchall()
+
+async def fetch_leaderboard_page_number(page, per_page=LEADERBOARD_PAGE_SIZE):
+    return await level_db.run(_leaderboard_rows_from, (page - 1) * per_page, per_page)
+
+async def get_leaderboard_embed(guild, rows, page, total):
+    users = await give_names.resolve([row['user_id'] for row in rows], guild)
+    ranks = await get_leaderboard_ranks(rows)
     desc = ""
-    for i, row in enumerate(sorted_users):
-        user = await bot_give.fetch_user(row['user_id'])
-        desc += f"**{i+1}. {user.name}** - Level {row['level']} ({row['exp']} EXP)\n"
+    for row in rows:
+        user = users.get(row['user_id'])
+        name = user.name if user else f"ID:{row['user_id']}"
+        desc += f"**{ranks[(row['level'], row['exp'])]}. {name}** - Level {row['level']} ({row['exp']} EXP)\n"
     embed = discord_give.Embed(title="\ud83d\udcca Leaderboard", description=desc, color=0x00ff00)
-    await ctx.send(embed=embed)
+    total_pages = max(1, (total + LEADERBOARD_PAGE_SIZE - 1) // LEADERBOARD_PAGE_SIZE)
+    embed.set_footer(text=f"Page {page}/{total_pages} | {total} ranked users")
+    return embed
+
+class LeaderboardView(discord_give.ui.View):
+    def __init__(self, author_id, rows, page, total):
+        super().__init__(timeout=None)
+        self.author_id = author_id
+        self.page = page
+        self.total = total
+        self.set_page_keys(rows)
+        self.update_buttons()
+
+    def set_page_keys(self, rows):
+        self.first_key = (rows[0]['level'], rows[0]['exp'], rows[0]['user_id'])
+        self.last_key = (rows[-1]['level'], rows[-1]['exp'], rows[-1]['user_id'])
+
+    def update_buttons(self):
+        total_pages = (self.total + LEADERBOARD_PAGE_SIZE - 1) // LEADERBOARD_PAGE_SIZE
+        self.prev_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= total_pages
+
+    async def interaction_check(self, interaction: discord_give.Interaction) -> bool:
+        return interaction.user.id == self.author_id
+
+    @discord_give.ui.button(label="\u25c0\ufe0f Previous", style=discord_give.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord_give.Interaction, button: discord_give.ui.Button):
+        await self.turn_page(interaction, -1)
+
+    @discord_give.ui.button(label="Next \u25b6\ufe0f", style=discord_give.ButtonStyle.primary)
+    async def next_page(self, interaction: discord_give.Interaction, button: discord_give.ui.Button):
+        await self.turn_page(interaction, 1)
+
+    async def turn_page(self, interaction, direction):
+        await exp_buffer.flush()
+        if direction > 0:
+            rows = await fetch_leaderboard_page(after=self.last_key)
+        else:
+            rows = await fetch_leaderboard_page(before=self.first_key)
+        if not rows:
+            await interaction.response.send_message("No more users in that direction.", ephemeral=True)
+            return
+        self.page += direction
+        self.total = await get_tracked_user_count()
+        self.set_page_keys(rows)
+        self.update_buttons()
+        embed = await get_leaderboard_embed(interaction.guild, rows, self.page, self.total)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+@bot_give.command(name='lb')
+async def leaderboard(ctx, page: int = 1):
+    # Save buffered EXP first so the leaderboard reflects every message so far
+    await exp_buffer.flush()
+    page = max(1, page)
+    rows = await fetch_leaderboard_page_number(page)
+    if not rows:
+        await ctx.send(f"No users found on leaderboard page {page}.")
+        return
+    total = await get_tracked_user_count()
+    embed = await get_leaderboard_embed(ctx.guild, rows, page, total)
+    await ctx.send(embed=embed, view=LeaderboardView(ctx.author.id, rows, page, total))
+
+@bot_give.command(name='rank')
+async def rank(ctx, member: discord_give.Member = None):
+    member = member or ctx.author
+    data = await get_user_rank(member.id)
+    if not data:
+        await ctx.send(f"{member.mention} has no EXP yet.")
+        return
+    await ctx.send(f"\ud83c\udfc6 {member.mention} is ranked **#{data['rank']}** of {data['total']} (Level {data['level']}, {data['exp']} EXP)")
 giveaway_data = {}
 @bot_give.command(name="giveaways")
 async def start_giveaway(ctx, headline: str, winners: int, duration: str):
@@ -508,31 +1015,291 @@ def run_giveaway_bot():
 async def help_give(ctx):
     embed = discord_give.Embed(title="Giveaway Levels Bot Commands", color=discord_give.Color.green())
     embed.add_field(name="mul!check", value="Check your level and EXP.", inline=False)
-    embed.add_field(name="mul!lb", value="Show the leaderboard.", inline=False)
+    embed.add_field(name="mul!lb [page]", value="Show the leaderboard.", inline=False)
+    embed.add_field(name="mul!rank [member]", value="Show your (or a member's) leaderboard rank.", inline=False)
     embed.add_field(name="mul!giveaways <headline> <winners> <duration>", value="Start a giveaway (admin only).", inline=False)
     await ctx.send(embed=embed)
 
 # ================== Invites Tracker Bot ==================
 import discord as discord_inv
-from discord.ext import commands as commands_inv
+from discord.ext import commands as commands_inv, tasks as tasks_inv
 import json as json_inv
 import os as os_inv
 import collections
+import csv as csv_inv
+import io as io_inv
 # --- SQLite setup for Invites Bot ---
-invites_db_lock = threading.Lock()
-invites_db = sqlite3.connect('invites.db', check_same_thread=False)
-invites_db.row_factory = sqlite3.Row
-invites_cursor = invites_db.cursor()
-invites_cursor.execute('''
-CREATE TABLE IF NOT EXISTS invites (
-    user_id INTEGER PRIMARY KEY,
-    points INTEGER NOT NULL
-)
-''')
-invites_db.commit()
+invites_db = AsyncDatabase('invites.db', schema=[
+    '''
+    CREATE TABLE IF NOT EXISTS invites (
+        user_id INTEGER PRIMARY KEY,
+        points INTEGER NOT NULL
+    )
+    ''',
+    # inv!lb all walks this index from the top instead of sorting the table
+    'CREATE INDEX IF NOT EXISTS idx_invites_points ON invites (points)',
+    # Who brought each member in, so a leave can take the point back without
+    # asking Discord. status: valid, fake, left, quick_leave
+    '''
+    CREATE TABLE IF NOT EXISTS invite_attributions (
+        guild_id INTEGER NOT NULL,
+        joiner_id INTEGER NOT NULL,
+        inviter_id INTEGER,
+        code TEXT,
+        confidence REAL NOT NULL,
+        joined_at REAL NOT NULL,
+        left_at REAL,
+        status TEXT NOT NULL,
+        PRIMARY KEY (guild_id, joiner_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_invite_attributions_inviter ON invite_attributions (inviter_id, status)',
+    # Last known use counts, so a restart diffs against what was seen before going offline
+    '''
+    CREATE TABLE IF NOT EXISTS invite_snapshots (
+        guild_id INTEGER NOT NULL,
+        code TEXT NOT NULL,
+        uses INTEGER NOT NULL,
+        inviter_id INTEGER,
+        max_uses INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, code)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS invite_vanity_snapshots (
+        guild_id INTEGER PRIMARY KEY,
+        uses INTEGER NOT NULL
+    )
+    ''',
+    # Append-only log of every point change, plus per-day totals kept in step
+    # with it so windowed leaderboards never scan the log
+    '''
+    CREATE TABLE IF NOT EXISTS invite_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id INTEGER,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_invite_events_time ON invite_events (created_at)',
+    '''
+    CREATE TABLE IF NOT EXISTS invite_daily (
+        day INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        PRIMARY KEY (day, user_id)
+    )
+    ''',
+    # Monthly roll-ups were written but never read; all-time totals live in invites
+    'DROP TABLE IF EXISTS invite_monthly',
+])
+
+# --- Invite diff engine ---
+# Joins are not attributed one fetch at a time. Each guild has an engine that
+# collects the joins arriving within INVITE_JOIN_DEBOUNCE seconds of the first
+# one, takes a single guild.invites() snapshot for the whole batch, and hands
+# out the batch by the per-code use-count deltas. Snapshots are serialized per
+# guild, so two fetches can never interleave and double-count a use.
+INVITE_JOIN_DEBOUNCE = 1.0
+INVITE_METRIC_SAMPLES = 1000
+INVITE_WARMUP_CONCURRENCY = 5  # Guilds fetching their invites at once on startup
+
+InviteAttribution = collections.namedtuple('InviteAttribution', 'code inviter_id confidence latency')
+
+class InviteDiffEngine:
+    def __init__(self, guild_id, debounce=INVITE_JOIN_DEBOUNCE):
+        self.guild_id = guild_id
+        self.debounce = debounce
+        self.snapshot = None  # code -> (uses, inviter_id, max_uses), None until the first fetch
+        self.vanity_uses = None
+        self.persisted = None  # Last session's snapshot, only used to count the uses missed while offline
+        self.persisted_vanity = None
+        self.warming = None  # Set once the first live fetch after seed() is done
+        self.pending = []  # (member, arrived_at, future)
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+        self.latencies = collections.deque(maxlen=INVITE_METRIC_SAMPLES)
+        self.confidences = collections.deque(maxlen=INVITE_METRIC_SAMPLES)
+        self.joins = 0
+        self.fetches = 0
+        self.unattributed = 0
+
+    async def _fetch(self, guild):
+        invites = await guild.invites()
+        self.fetches += 1
+        return {
+            invite.code: (invite.uses or 0, invite.inviter.id if invite.inviter else None, invite.max_uses or 0)
+            for invite in invites
+        }
 
-# --- Invite Cache for Tracking ---
-invite_cache = {}
+    async def _fetch_vanity(self, guild):
+        if not guild.vanity_url_code:
+            return None
+        vanity = await guild.vanity_invite()
+        return vanity.uses if vanity else None
+
+    def seed(self, snapshot, vanity_uses):
+        # The persisted snapshot is never a baseline for live joins: a diff
+        # against it would lump every use from while the bot was offline into
+        # the first batch. refresh() compares it with the first live fetch, and
+        # batches wait for that fetch.
+        if self.snapshot is None and snapshot is not None:
+            self.persisted = snapshot
+            self.persisted_vanity = vanity_uses
+            if self.warming is None:
+                self.warming = asyncio.Event()
+
+    def _persist(self, before, vanity_before):
+        # Writes only what changed; the writer thread applies these in order
+        before = before or {}
+        changed = [
+            (self.guild_id, code, *entry) for code, entry in self.snapshot.items() if before.get(code) != entry
+        ]
+        removed = [(self.guild_id, code) for code in before if code not in self.snapshot]
+        vanity = self.vanity_uses if self.vanity_uses != vanity_before else None
+        if changed or removed or vanity is not None:
+            invites_db.submit(_save_invite_snapshot, self.guild_id, changed, removed, vanity)
+
+    async def refresh(self, guild):
+        # Returns the uses that happened while no one was watching, as {inviter_id: count}
+        async with self.lock:
+            try:
+                if self.snapshot is not None:
+                    before, vanity_before = self.snapshot, self.vanity_uses
+                else:
+                    before, vanity_before = self.persisted, self.persisted_vanity
+                self.snapshot = await self._fetch(guild)
+                self.vanity_uses = await self._fetch_vanity(guild)
+                self.persisted = self.persisted_vanity = None
+                self._persist(before, vanity_before)
+            finally:
+                if self.warming is not None:
+                    self.warming.set()
+                    self.warming = None
+        missed = {}
+        if before is not None:
+            for code, (uses, inviter_id, _) in self.snapshot.items():
+                previous = before.get(code, (0, None, 0))[0]
+                if inviter_id and uses > previous:
+                    missed[inviter_id] = missed.get(inviter_id, 0) + uses - previous
+        return missed
+
+    def invite_created(self, invite):
+        # A new invite starts from its current uses, so its first use is a delta
+        if self.snapshot is not None:
+            before = dict(self.snapshot)
+            self.snapshot[invite.code] = (invite.uses or 0, invite.inviter.id if invite.inviter else None, invite.max_uses or 0)
+            self._persist(before, self.vanity_uses)
+
+    async def join(self, member):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((member, time.monotonic(), future))
+        self.joins += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_after(member.guild))
+        return await future
+
+    async def _flush_after(self, guild):
+        await asyncio.sleep(self.debounce)
+        if self.warming is not None:
+            # Joins from before the first live fetch have their uses counted
+            # as offline credits there, so they end up unattributed here
+            await self.warming.wait()
+        async with self.lock:
+            batch, self.pending = self.pending, []
+            self.flush_task = None  # Joins from here on start the next batch
+            try:
+                attributions = await self._attribute(guild, len(batch))
+            except Exception as e:
+                print(f"Invite snapshot failed for guild {self.guild_id}: {e}")
+                attributions = [(None, None, 0.0)] * len(batch)
+        now = time.monotonic()
+        for (member, arrived_at, future), (code, inviter_id, confidence) in zip(batch, attributions):
+            attribution = InviteAttribution(code, inviter_id, confidence, now - arrived_at)
+            self.latencies.append(attribution.latency)
+            self.confidences.append(confidence)
+            if code is None:
+                self.unattributed += 1
+            if not future.done():
+                future.set_result(attribution)
+
+    async def _attribute(self, guild, joins):
+        before, vanity_before = self.snapshot, self.vanity_uses
+        after = await self._fetch(guild)
+        self.snapshot = after
+        try:
+            if before is None:
+                return [(None, None, 0.0)] * joins  # Nothing to diff against yet
+            return await self._diff(guild, before, after, joins)
+        finally:
+            self._persist(before, vanity_before)
+
+    async def _diff(self, guild, before, after, joins):
+        deltas = []  # (count, code, inviter_id, weight)
+        for code, (uses, inviter_id, _) in after.items():
+            previous = before.get(code, (0, None, 0))[0]
+            if uses > previous:
+                deltas.append((uses - previous, code, inviter_id, 1.0))
+        for code, (uses, inviter_id, max_uses) in before.items():
+            if code not in after and max_uses and uses == max_uses - 1:
+                # Deleted on reaching max uses: probably used once, but it may just have been revoked
+                deltas.append((1, code, inviter_id, 0.5))
+        total = sum(delta[0] for delta in deltas)
+        if total < joins:
+            vanity_uses = await self._fetch_vanity(guild)
+            if vanity_uses is not None and self.vanity_uses is not None and vanity_uses > self.vanity_uses:
+                deltas.append((vanity_uses - self.vanity_uses, 'vanity', None, 1.0))  # Can't track inviter for vanity
+                total += vanity_uses - self.vanity_uses
+            if vanity_uses is not None:
+                self.vanity_uses = vanity_uses
+        # Which join used which code is unknowable within a batch, so each join
+        # gets a use slot and the chance that its code is the right one
+        slots = []
+        for count, code, inviter_id, weight in sorted(deltas, key=lambda delta: delta[0], reverse=True):
+            confidence = weight * count / max(total, joins)
+            slots.extend([(code, inviter_id, confidence)] * count)
+        return (slots + [(None, None, 0.0)] * joins)[:joins]
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] if latencies else 0.0
+        return {
+            'joins': self.joins,
+            'fetches': self.fetches,
+            'unattributed': self.unattributed,
+            'latency_p50': pct(50),
+            'latency_p95': pct(95),
+            'mean_confidence': sum(self.confidences) / len(self.confidences) if self.confidences else 0.0,
+        }
+
+def _save_invite_snapshot(conn, guild_id, changed, removed, vanity_uses):
+    conn.executemany(
+        'INSERT OR REPLACE INTO invite_snapshots (guild_id, code, uses, inviter_id, max_uses) VALUES (?, ?, ?, ?, ?)', changed
+    )
+    conn.executemany('DELETE FROM invite_snapshots WHERE guild_id = ? AND code = ?', removed)
+    if vanity_uses is not None:
+        conn.execute('INSERT OR REPLACE INTO invite_vanity_snapshots (guild_id, uses) VALUES (?, ?)', (guild_id, vanity_uses))
+
+def _load_invite_snapshots(conn):
+    snapshots = {}
+    for row in conn.execute('SELECT guild_id, code, uses, inviter_id, max_uses FROM invite_snapshots'):
+        snapshots.setdefault(row['guild_id'], {})[row['code']] = (row['uses'], row['inviter_id'], row['max_uses'])
+    vanity = {row['guild_id']: row['uses'] for row in conn.execute('SELECT guild_id, uses FROM invite_vanity_snapshots')}
+    return snapshots, vanity
+
+async def load_invite_snapshots():
+    # Returns ({guild_id: snapshot}, {guild_id: vanity uses}) as last persisted
+    return await invites_db.run(_load_invite_snapshots)
+
+invite_engines = {}
+
+def get_invite_engine(guild_id):
+    if guild_id not in invite_engines:
+        invite_engines[guild_id] = InviteDiffEngine(guild_id)
+    return invite_engines[guild_id]
 
 intents_inv = discord_inv.Intents.all()
 bot_inv = commands_inv.Bot(command_prefix='inv!', intents=intents_inv)
@@ -541,103 +1308,347 @@ if not os_inv.path.exists(data_file):
     with open(data_file, 'w') as f:
         json_inv.dump({}, f)
 bot_inv.remove_command('help')
+inv_names = UserNameResolver(bot_inv)
 
 @bot_inv.event
 async def on_ready():
     print(f"Logged in as {bot_inv.user} (Invite Tracker)")
+    if not compact_invite_history.is_running():
+        compact_invite_history.start()
+    started = time.perf_counter()
+    snapshots, vanity = await load_invite_snapshots()
+    # Seed every engine before any fetch, so join batches arriving mid warm-up
+    # wait for their guild's first live fetch instead of diffing against the
+    # persisted snapshot. Uses from before that fetch are credited as offline;
+    # the joins they belong to are recorded unattributed.
     for guild in bot_inv.guilds:
-        invites = await guild.invites()
-        invite_cache[guild.id] = {invite.code: invite.uses for invite in invites}
+        get_invite_engine(guild.id).seed(snapshots.get(guild.id), vanity.get(guild.id))
+    semaphore = asyncio.Semaphore(INVITE_WARMUP_CONCURRENCY)
+    missed = await asyncio.gather(*(warm_up_invites(guild, semaphore) for guild in bot_inv.guilds))
+    print(f"📨 Invite snapshots for {len(bot_inv.guilds)} guild(s) ready in {(time.perf_counter() - started) * 1000:.0f} ms, "
+          f"{sum(missed)} use(s) credited from while offline")
+
+async def warm_up_invites(guild, semaphore):
+    async with semaphore:
+        try:
+            missed = await get_invite_engine(guild.id).refresh(guild)
+        except Exception as e:
+            print(f"Could not fetch invites for guild {guild.id}: {e}")
+            return 0
+    # Joins while the bot was offline have no member to put in the ledger,
+    # but their inviters still earned the points
+    await credit_invite_points(missed, guild.id)
+    return sum(missed.values())
 
 @bot_inv.event
 async def on_guild_join(guild):
-    invites = await guild.invites()
-    invite_cache[guild.id] = {invite.code: invite.uses for invite in invites}
+    await get_invite_engine(guild.id).refresh(guild)
+
+@bot_inv.event
+async def on_invite_create(invite):
+    if invite.guild is not None:
+        get_invite_engine(invite.guild.id).invite_created(invite)
 
 @bot_inv.event
 async def on_member_join(member):
-    guild = member.guild
-    before = invite_cache.get(guild.id, {})
-    invites = await guild.invites()
-    invite_cache[guild.id] = {invite.code: invite.uses for invite in invites}
-    used_code = None
-    inviter_id = None
-    for invite in invites:
-        if invite.code in before and invite.uses > before[invite.code]:
-            used_code = invite.code
-            inviter_id = invite.inviter.id if invite.inviter else None
-            break
-        elif invite.code not in before and invite.uses > 0:
-            used_code = invite.code
-            inviter_id = invite.inviter.id if invite.inviter else None
-            break
-    # Handle vanity URL
-    if not used_code and guild.vanity_url_code:
-        vanity = await guild.vanity_invite()
-        if vanity and vanity.uses > before.get('vanity', 0):
-            used_code = 'vanity'
-            inviter_id = None  # Can't track inviter for vanity
-    if inviter_id:
-        add_invite_points(inviter_id, 1)
+    attribution = await get_invite_engine(member.guild.id).join(member)
+    await record_invite_join(member, attribution)
 
 @bot_inv.event
 async def on_member_remove(member):
-    # Try to detect who invited this member (optional: store joiner->inviter mapping for accuracy)
-    # For now, just check invites again and update cache
-    guild = member.guild
-    invites = await guild.invites()
-    invite_cache[guild.id] = {invite.code: invite.uses for invite in invites}
-    # If you want to subtract from inviter, you need to store joiner->inviter mapping on join
-    # (not implemented here, but can be added if needed)
-    # For now, this will not subtract points unless you want to implement joiner->inviter mapping.
-    pass
-
-def get_invite_points(user_id):
-    with invites_db_lock:
-        row = invites_cursor.execute('SELECT points FROM invites WHERE user_id = ?', (user_id,)).fetchone()
-        return row['points'] if row else 0
-
-def set_invite_points(user_id, points):
-    with invites_db_lock:
-        if invites_cursor.execute('SELECT 1 FROM invites WHERE user_id = ?', (user_id,)).fetchone():
-            invites_cursor.execute('UPDATE invites SET points = ? WHERE user_id = ?', (points, user_id))
-        else:
-            invites_cursor.execute('INSERT INTO invites (user_id, points) VALUES (?, ?)', (user_id, points))
-        invites_db.commit()
-
-def add_invite_points(user_id, points):
-    current = get_invite_points(user_id)
-    set_invite_points(user_id, current + points)
+    # One ledger lookup, no invite fetch: a leave never changes use counts, and
+    # a snapshot taken now would swallow the deltas of joins still in a batch
+    await record_invite_leave(member.guild.id, member.id)
+
+async def get_invite_points(user_id):
+    row = await invites_db.fetchone('SELECT points FROM invites WHERE user_id = ?', (user_id,))
+    return row['points'] if row else 0
+
+# Point changes are one statement each: the delta is applied inside SQLite and
+# clamped at zero, so concurrent changes cannot overwrite one another. Every
+# change actually applied is also appended to invite_events and added to that
+# day's bucket in the same transaction.
+CHANGE_POINTS_SQL = (
+    'INSERT INTO invites (user_id, points) VALUES (?1, MAX(?2, 0)) '
+    'ON CONFLICT(user_id) DO UPDATE SET points = MAX(points + ?2, 0)'
+)
+SET_POINTS_SQL = (
+    'INSERT INTO invites (user_id, points) VALUES (?1, MAX(?2, 0)) '
+    'ON CONFLICT(user_id) DO UPDATE SET points = MAX(?2, 0)'
+)
+LOG_EVENT_SQL = 'INSERT INTO invite_events (guild_id, user_id, delta, kind, created_at) VALUES (?, ?, ?, ?, ?)'
+BUMP_DAILY_SQL = (
+    'INSERT INTO invite_daily (day, user_id, points) VALUES (?, ?, ?) '
+    'ON CONFLICT(day, user_id) DO UPDATE SET points = points + excluded.points'
+)
 
-def remove_invite_points(user_id, points):
-    current = get_invite_points(user_id)
-    set_invite_points(user_id, max(0, current - points))
+def _log_invite_events(conn, changes, kind, guild_id):
+    now = time.time()
+    day = int(now // 86400)
+    conn.executemany(LOG_EVENT_SQL, [(guild_id, user_id, delta, kind, now) for user_id, delta in changes])
+    conn.executemany(BUMP_DAILY_SQL, [(day, user_id, delta) for user_id, delta in changes])
+
+def _apply_invite_changes(conn, changes, kind, guild_id):
+    # The log records the change actually applied: a removal clamped at zero
+    # only counts the points that were there to remove
+    totals = []
+    applied = []
+    for user_id, delta in changes:
+        row = conn.execute('SELECT points FROM invites WHERE user_id = ?', (user_id,)).fetchone()
+        previous = row['points'] if row else 0
+        points = conn.execute(CHANGE_POINTS_SQL + ' RETURNING points', (user_id, delta)).fetchone()['points']
+        totals.append(points)
+        if points != previous:
+            applied.append((user_id, points - previous))
+    _log_invite_events(conn, applied, kind, guild_id)
+    return totals
+
+def _change_invite_points(conn, user_id, delta, kind, guild_id=None):
+    return _apply_invite_changes(conn, [(user_id, delta)], kind, guild_id)[0]
+
+def _change_invite_points_bulk(conn, changes, kind, guild_id=None):
+    return len(_apply_invite_changes(conn, changes, kind, guild_id))
+
+def _set_invite_points_bulk(conn, totals, kind):
+    # The log records the change each new total makes. A user listed twice
+    # ends on the last total, so only that one is compared with the old total.
+    totals = list(dict(totals).items())
+    changes = []
+    for user_id, points in totals:
+        row = conn.execute('SELECT points FROM invites WHERE user_id = ?', (user_id,)).fetchone()
+        changes.append((user_id, max(points, 0) - (row['points'] if row else 0)))
+    conn.executemany(SET_POINTS_SQL, totals)
+    _log_invite_events(conn, [change for change in changes if change[1]], kind, None)
+    return len(totals)
+
+async def set_invite_points(user_id, points, kind='admin'):
+    await invites_db.run(_set_invite_points_bulk, [(user_id, points)], kind)
+
+async def change_invite_points(user_id, delta, kind='admin', guild_id=None):
+    # Returns the new total
+    return await invites_db.run(_change_invite_points, user_id, delta, kind, guild_id)
+
+async def add_invite_points(user_id, points):
+    return await change_invite_points(user_id, points)
+
+async def remove_invite_points(user_id, points):
+    return await change_invite_points(user_id, -points)
+
+async def change_invite_points_bulk(changes, kind='admin', guild_id=None):
+    # changes: iterable of (user_id, delta), applied in a single transaction
+    return await invites_db.run(_change_invite_points_bulk, list(changes), kind, guild_id)
+
+async def set_invite_points_bulk(totals, kind='import'):
+    # totals: iterable of (user_id, points), applied in a single transaction
+    return await invites_db.run(_set_invite_points_bulk, list(totals), kind)
+
+async def credit_invite_points(points_by_user, guild_id=None):
+    if points_by_user:
+        await change_invite_points_bulk(points_by_user.items(), 'offline', guild_id)
+
+# --- Attribution ledger ---
+# A join from an account younger than INVITE_FAKE_ACCOUNT_AGE is logged as fake
+# and earns nothing. A leave takes back the point of a credited join. A leave
+# within INVITE_QUICK_LEAVE_WINDOW of the join is logged as a quick leave.
+INVITE_FAKE_ACCOUNT_AGE = 7 * 24 * 3600  # Seconds
+INVITE_QUICK_LEAVE_WINDOW = 24 * 3600  # Seconds
+
+def _record_invite_join(conn, guild_id, joiner_id, attribution, status, joined_at):
+    previous = conn.execute(
+        'SELECT inviter_id, status FROM invite_attributions WHERE guild_id = ? AND joiner_id = ?', (guild_id, joiner_id)
+    ).fetchone()
+    if previous and previous['status'] == 'valid' and previous['inviter_id']:
+        _change_invite_points(conn, previous['inviter_id'], -1, 'leave', guild_id)  # Left while the bot was offline
+    conn.execute(
+        'INSERT OR REPLACE INTO invite_attributions (guild_id, joiner_id, inviter_id, code, confidence, joined_at, left_at, status) '
+        'VALUES (?, ?, ?, ?, ?, ?, NULL, ?)',
+        (guild_id, joiner_id, attribution.inviter_id, attribution.code, attribution.confidence, joined_at, status)
+    )
+    if status == 'valid' and attribution.inviter_id:
+        _change_invite_points(conn, attribution.inviter_id, 1, 'join', guild_id)
+
+async def record_invite_join(member, attribution):
+    joined_at = time.time()
+    fake = joined_at - member.created_at.timestamp() < INVITE_FAKE_ACCOUNT_AGE
+    status = 'fake' if fake else 'valid'
+    await invites_db.run(_record_invite_join, member.guild.id, member.id, attribution, status, joined_at)
+    return status
+
+def _record_invite_leave(conn, guild_id, joiner_id, left_at):
+    row = conn.execute(
+        'UPDATE invite_attributions SET left_at = ?, '
+        "status = CASE WHEN ? - joined_at < ? THEN 'quick_leave' ELSE 'left' END "
+        "WHERE guild_id = ? AND joiner_id = ? AND status = 'valid' RETURNING inviter_id, status",
+        (left_at, left_at, INVITE_QUICK_LEAVE_WINDOW, guild_id, joiner_id)
+    ).fetchone()
+    if row is None:
+        return None  # Not credited to anyone (unknown, fake, or already left)
+    if row['inviter_id']:
+        _change_invite_points(conn, row['inviter_id'], -1, 'leave', guild_id)
+    return row['status']
+
+async def record_invite_leave(guild_id, joiner_id):
+    return await invites_db.run(_record_invite_leave, guild_id, joiner_id, time.time())
+
+async def get_inviter_breakdown(inviter_id):
+    rows = await invites_db.fetchall(
+        'SELECT status, COUNT(*) AS joins FROM invite_attributions WHERE inviter_id = ? GROUP BY status', (inviter_id,)
+    )
+    return {row['status']: row['joins'] for row in rows}
+
+@bot_inv.command(name='invites')
+async def invite_summary(ctx, member: discord_inv.Member = None):
+    member = member or ctx.author
+    points = await get_invite_points(member.id)
+    breakdown = await get_inviter_breakdown(member.id)
+    embed = discord_inv.Embed(title=f"📨 Invites for {member.display_name}", description=f"**{points}** points", color=0x00ff00)
+    embed.add_field(name="Still here", value=str(breakdown.get('valid', 0)))
+    embed.add_field(name="Left", value=str(breakdown.get('left', 0)))
+    embed.add_field(name="Quick leaves", value=str(breakdown.get('quick_leave', 0)))
+    embed.add_field(name="Fake (new accounts)", value=str(breakdown.get('fake', 0)))
+    await ctx.send(embed=embed)
 
 @bot_inv.command()
 async def add(ctx, member: discord_inv.Member, points: int):
-    add_invite_points(member.id, points)
+    await add_invite_points(member.id, points)
     await ctx.send(f"✅ Added {points} points to {member.display_name}.")
 
 @bot_inv.command()
 async def remove(ctx, member: discord_inv.Member, points: int):
-    remove_invite_points(member.id, points)
+    await remove_invite_points(member.id, points)
     await ctx.send(f"❌ Removed {points} points from {member.display_name}.")
 
+# --- Bulk point admin ---
+# Each command below touches any number of members in one transaction
+@bot_inv.command()
+@commands_inv.has_permissions(administrator=True)
+async def bulkadd(ctx, points: int, members: commands_inv.Greedy[discord_inv.Member]):
+    if not members:
+        await ctx.send("❌ Mention at least one member: `inv!bulkadd <points> @member...`")
+        return
+    member_ids = {member.id for member in members}
+    await change_invite_points_bulk((member_id, points) for member_id in member_ids)
+    verb = "Added" if points >= 0 else "Removed"
+    await ctx.send(f"✅ {verb} {abs(points)} points for {len(member_ids)} member(s).")
+
+@bot_inv.command(name='export')
+@commands_inv.has_permissions(administrator=True)
+async def export_points(ctx):
+    rows = await invites_db.fetchall('SELECT user_id, points FROM invites ORDER BY points DESC')
+    buffer = io_inv.StringIO()
+    writer = csv_inv.writer(buffer)
+    writer.writerow(['user_id', 'points'])
+    writer.writerows((row['user_id'], row['points']) for row in rows)
+    data = io_inv.BytesIO(buffer.getvalue().encode())
+    await ctx.send(f"📤 Exported {len(rows)} member(s).", file=discord_inv.File(data, filename='invite_points.csv'))
+
+@bot_inv.command(name='import')
+@commands_inv.has_permissions(administrator=True)
+async def import_points(ctx, mode: str = 'set'):
+    # CSV with user_id,points columns; mode "set" replaces totals, "add" adjusts them
+    if mode not in ('set', 'add'):
+        await ctx.send("❌ Mode must be `set` or `add`.")
+        return
+    if not ctx.message.attachments:
+        await ctx.send("❌ Attach a CSV file with `user_id,points` columns.")
+        return
+    line_number = 0
+    try:
+        text = (await ctx.message.attachments[0].read()).decode('utf-8-sig')
+        rows = []
+        for line_number, record in enumerate(csv_inv.reader(io_inv.StringIO(text)), start=1):
+            if not record or (line_number == 1 and not record[0].strip().isdigit()):
+                continue  # Blank line or header
+            rows.append((int(record[0]), int(record[1])))
+    except (UnicodeDecodeError, ValueError, IndexError):
+        await ctx.send(f"❌ Could not read the CSV (line {line_number}): every row needs a user ID and a whole number of points.")
+        return
+    if mode == 'set':
+        await set_invite_points_bulk(rows)
+    else:
+        await change_invite_points_bulk(rows, 'import')
+    await ctx.send(f"📥 Imported {len(rows)} row(s) ({mode}).")
+
+@bulkadd.error
+@export_points.error
+@import_points.error
+async def bulk_points_error(ctx, error):
+    if isinstance(error, commands_inv.MissingPermissions):
+        await ctx.send("❌ You need the Administrator permission to use this command.")
+    elif isinstance(error, commands_inv.BadArgument):
+        await ctx.send(f"❌ {error}")
+    else:
+        raise error
+
+# --- Windowed leaderboards ---
+# week and month read the daily buckets instead of the event log, so their cost
+# grows with the number of users active in the window (at most 7 or 30 buckets
+# each), not with the number of invites. all reads the running totals. A
+# background job deletes buckets past the longest window and raw events past
+# INVITE_EVENT_RETENTION_DAYS.
+LEADERBOARD_WINDOWS = {'week': 7, 'month': 30, 'all': None}
+LEADERBOARD_TITLES = {'week': "Top inviters this week!", 'month': "Top inviters this month!", 'all': "Top inviters of all time!"}
+INVITE_DAILY_RETENTION_DAYS = 35
+INVITE_EVENT_RETENTION_DAYS = 90
+
+async def fetch_invite_leaderboard(window, limit=10):
+    days = LEADERBOARD_WINDOWS[window]
+    if days is None:
+        return await invites_db.fetchall('SELECT user_id, points FROM invites WHERE points > 0 ORDER BY points DESC LIMIT ?', (limit,))
+    first_day = int(time.time() // 86400) - days + 1
+    return await invites_db.fetchall(
+        'SELECT user_id, SUM(points) AS points FROM invite_daily WHERE day >= ? '
+        'GROUP BY user_id HAVING SUM(points) > 0 ORDER BY points DESC LIMIT ?',
+        (first_day, limit)
+    )
+
+def _compact_invite_history(conn, now):
+    cutoff_day = int(now // 86400) - INVITE_DAILY_RETENTION_DAYS
+    buckets = conn.execute('DELETE FROM invite_daily WHERE day < ?', (cutoff_day,)).rowcount
+    events = conn.execute(
+        'DELETE FROM invite_events WHERE created_at < ?', (now - INVITE_EVENT_RETENTION_DAYS * 86400,)
+    ).rowcount
+    return buckets, events
+
+@tasks_inv.loop(hours=6)
+async def compact_invite_history():
+    try:
+        buckets, events = await invites_db.run(_compact_invite_history, time.time())
+    except Exception as e:
+        print(f"Invite history compaction failed: {e}")
+        return
+    if buckets or events:
+        print(f"📨 Pruned {buckets} daily invite bucket(s) and {events} invite event(s)")
+
 @bot_inv.command()
-async def lb(ctx):
-    with invites_db_lock:
-        rows = invites_cursor.execute('SELECT user_id, points FROM invites ORDER BY points DESC LIMIT 10').fetchall()
+async def lb(ctx, window: str = 'all'):
+    window = window.lower()
+    if window not in LEADERBOARD_WINDOWS:
+        await ctx.send("❌ Use `inv!lb week`, `inv!lb month` or `inv!lb all`.")
+        return
+    rows = await fetch_invite_leaderboard(window)
     if not rows:
         await ctx.send(embed=discord_inv.Embed(title="🏆 Invite Leaderboard", description="No invites yet!", color=0x00ff00))
         return
+    users = await inv_names.resolve([row['user_id'] for row in rows], ctx.guild)
     desc = ""
     medals = ["🥇", "🥈", "🥉"] + ["🏅"] * 7
     for i, row in enumerate(rows, start=1):
-        user = await bot_inv.fetch_user(row['user_id'])
+        user = users.get(row['user_id'])
+        name = user.display_name if user else f"ID:{row['user_id']}"
         medal = medals[i-1] if i <= len(medals) else "🏅"
-        desc += f"{medal} **{user.display_name}** — `{row['points']} invites`\n"
+        desc += f"{medal} **{name}** — `{row['points']} invites`\n"
     embed = discord_inv.Embed(title="🏆 Invite Leaderboard", description=desc, color=discord_inv.Color.gold())
-    embed.set_footer(text="Top inviters this week!")
+    embed.set_footer(text=LEADERBOARD_TITLES[window])
+    await ctx.send(embed=embed)
+
+@bot_inv.command()
+async def invitestats(ctx):
+    stats = get_invite_engine(ctx.guild.id).stats()
+    embed = discord_inv.Embed(title="📈 Invite Tracking", color=0x00ff00)
+    embed.add_field(name="Joins", value=f"{stats['joins']} joins, {stats['fetches']} invite fetches", inline=False)
+    embed.add_field(name="Attribution delay", value=f"p50 {stats['latency_p50']:.2f}s · p95 {stats['latency_p95']:.2f}s", inline=False)
+    embed.add_field(name="Confidence", value=f"{stats['mean_confidence']:.0%} average, {stats['unattributed']} unattributed", inline=False)
     await ctx.send(embed=embed)
 
 def run_invites_bot():
@@ -652,66 +1663,56 @@ import discord as discord_ticket
 from discord.ext import commands as commands_ticket
 from discord.ui import View as View_ticket, Button as Button_ticket, Select as Select_ticket
 from collections import defaultdict as defaultdict_ticket
-import sqlite3
-# --- SQLite setup for Ticket Bot ---
-ticket_db_lock = threading.Lock()
-ticket_db = sqlite3.connect('tickets.db', check_same_thread=False)
-ticket_db.row_factory = sqlite3.Row
-ticket_cursor = ticket_db.cursor()
-ticket_cursor.execute('''
-CREATE TABLE IF NOT EXISTS tickets (
-    ticket_id INTEGER PRIMARY KEY,
-    creator_id INTEGER NOT NULL,
-    staff_id INTEGER,
-    status TEXT NOT NULL
-)
-''')
-ticket_db.commit()
-
-# --- SQLite setup for staff ratings ---
-staff_ratings_db_lock = threading.Lock()
-staff_ratings_cursor = ticket_db.cursor()
-staff_ratings_cursor.execute('''
-CREATE TABLE IF NOT EXISTS staff_ratings (
-    staff_id INTEGER NOT NULL,
-    rating INTEGER NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-''')
-ticket_db.commit()
-
-# --- SQLite setup for vouches (using ticket_db) ---
-vouch_db_lock = threading.Lock()
-vouch_cursor = ticket_db.cursor()
-vouch_cursor.execute('''
-CREATE TABLE IF NOT EXISTS vouches (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    staff_id INTEGER NOT NULL,
-    user_id INTEGER NOT NULL,
-    rating INTEGER NOT NULL,
-    description TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-''')
-ticket_db.commit()
-
-def add_staff_rating(staff_id, rating):
-    with staff_ratings_db_lock:
-        staff_ratings_cursor.execute('INSERT INTO staff_ratings (staff_id, rating) VALUES (?, ?)', (staff_id, rating))
-        ticket_db.commit()
-
-def get_staff_ratings(staff_id):
-    with staff_ratings_db_lock:
-        rows = staff_ratings_cursor.execute('SELECT rating FROM staff_ratings WHERE staff_id = ?', (staff_id,)).fetchall()
-        return [row['rating'] for row in rows]
+# --- SQLite setup for Ticket Bot (tickets, staff ratings and vouches share tickets.db) ---
+ticket_db = AsyncDatabase('tickets.db', schema=[
+    '''
+    CREATE TABLE IF NOT EXISTS tickets (
+        ticket_id INTEGER PRIMARY KEY,
+        creator_id INTEGER NOT NULL,
+        staff_id INTEGER,
+        status TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS staff_ratings (
+        staff_id INTEGER NOT NULL,
+        rating INTEGER NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS vouches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        staff_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        rating INTEGER NOT NULL,
+        description TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Keyset pagination indexes: newest first, id breaks timestamp ties
+    'CREATE INDEX IF NOT EXISTS idx_vouches_user_time ON vouches (user_id, timestamp DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_vouches_time ON vouches (timestamp DESC, id DESC)',
+])
+
+async def add_staff_rating(staff_id, rating):
+    await ticket_db.execute('INSERT INTO staff_ratings (staff_id, rating) VALUES (?, ?)', (staff_id, rating))
+
+async def get_staff_rating_summaries(limit=25):
+    # One row per rated staff member: (staff_id, count, avg)
+    return await ticket_db.fetchall(
+        'SELECT staff_id, COUNT(*) AS count, AVG(rating) AS avg FROM staff_ratings '
+        'GROUP BY staff_id ORDER BY avg DESC, count DESC LIMIT ?',
+        (limit,)
+    )
 
-def count_five_star_ratings(staff_id):
-    with staff_ratings_db_lock:
-        row = staff_ratings_cursor.execute('SELECT COUNT(*) as count FROM staff_ratings WHERE staff_id = ? AND rating = 5', (staff_id,)).fetchone()
-        return row['count'] if row else 0
+async def count_five_star_ratings(staff_id):
+    row = await ticket_db.fetchone('SELECT COUNT(*) as count FROM staff_ratings WHERE staff_id = ? AND rating = 5', (staff_id,))
+    return row['count'] if row else 0
 
 intents_ticket = discord_ticket.Intents.all()
 bot_ticket = commands_ticket.Bot(command_prefix="dio!", intents=intents_ticket)
+ticket_names = UserNameResolver(bot_ticket)
 
 # Persistent view for ticket controls
 class PersistentTicketView(View_ticket):
@@ -726,7 +1727,7 @@ class CloseTicketButton(Button_ticket):
         super().__init__(label="🔒 Close Ticket", style=discord_ticket.ButtonStyle.secondary, custom_id=f"close_ticket:{creator_id}")
         self.creator_id = creator_id
     async def callback(self, interaction: discord_ticket.Interaction):
-        ticket_data = get_ticket(interaction.channel.id)
+        ticket_data = await get_ticket(interaction.channel.id)
         if not ticket_data:
             await interaction.response.send_message("⚠️ Internal error.", ephemeral=True)
             return
@@ -752,7 +1753,7 @@ class TakeRequestButton(Button_ticket):
         super().__init__(label="\U0001f3af Take Request", style=discord_ticket.ButtonStyle.primary, custom_id=f"take_request:{creator_id}")
         self.creator_id = creator_id
     async def callback(self, interaction: discord_ticket.Interaction):
-        ticket_data = get_ticket(interaction.channel.id)
+        ticket_data = await get_ticket(interaction.channel.id)
         if not ticket_data:
             await interaction.response.send_message("\u26a0\ufe0f Internal error.", ephemeral=True)
             return
@@ -762,7 +1763,7 @@ class TakeRequestButton(Button_ticket):
         if interaction.user.id == ticket_data["creator_id"]:
             await interaction.response.send_message("\u274c You cannot take your own request.", ephemeral=True)
             return
-        update_ticket_staff(interaction.channel.id, interaction.user.id)
+        await update_ticket_staff(interaction.channel.id, interaction.user.id)
         await interaction.channel.send(f"\u2705 This request has been taken by {interaction.user.mention}.")
         # Disable the button in the view
         view = await interaction.message.view.from_message(interaction.message)
@@ -792,14 +1793,14 @@ async def on_interaction(interaction: discord_ticket.Interaction):
         return
     # Handle persistent DeleteTicketButton
     if interaction.data.get("custom_id", "").startswith("delete_ticket:"):
-        ticket_data = get_ticket(interaction.channel.id)
+        ticket_data = await get_ticket(interaction.channel.id)
         if not ticket_data:
             await interaction.response.send_message("\u274c This ticket does not exist or is already closed.", ephemeral=True)
             return
         if interaction.user.id != ticket_data['creator_id']:
             await interaction.response.send_message("\u274c Only the ticket creator can delete this ticket.", ephemeral=True)
             return
-        delete_ticket(interaction.channel.id)
+        await delete_ticket(interaction.channel.id)
         await interaction.response.send_message("\U0001f5d1\ufe0f Ticket deleted.", ephemeral=True)
         await interaction.channel.delete()
         staff_id = ticket_data['staff_id']
@@ -818,28 +1819,21 @@ async def on_interaction(interaction: discord_ticket.Interaction):
 
 ticket_counter = 0
 # --- SQLite helper functions for tickets ---
-def get_ticket(ticket_id):
-    with ticket_db_lock:
-        row = ticket_cursor.execute('SELECT creator_id, staff_id, status FROM tickets WHERE ticket_id = ?', (ticket_id,)).fetchone()
-        if row:
-            return {'creator_id': row['creator_id'], 'staff_id': row['staff_id'], 'status': row['status']}
-        else:
-            return None
+async def get_ticket(ticket_id):
+    row = await ticket_db.fetchone('SELECT creator_id, staff_id, status FROM tickets WHERE ticket_id = ?', (ticket_id,))
+    if row:
+        return {'creator_id': row['creator_id'], 'staff_id': row['staff_id'], 'status': row['status']}
+    else:
+        return None
 
-def create_ticket(ticket_id, creator_id):
-    with ticket_db_lock:
-        ticket_cursor.execute('INSERT OR REPLACE INTO tickets (ticket_id, creator_id, staff_id, status) VALUES (?, ?, ?, ?)', (ticket_id, creator_id, None, 'open'))
-        ticket_db.commit()
+async def create_ticket(ticket_id, creator_id):
+    await ticket_db.execute('INSERT OR REPLACE INTO tickets (ticket_id, creator_id, staff_id, status) VALUES (?, ?, ?, ?)', (ticket_id, creator_id, None, 'open'))
 
-def update_ticket_staff(ticket_id, staff_id):
-    with ticket_db_lock:
-        ticket_cursor.execute('UPDATE tickets SET staff_id = ? WHERE ticket_id = ?', (staff_id, ticket_id))
-        ticket_db.commit()
+async def update_ticket_staff(ticket_id, staff_id):
+    await ticket_db.execute('UPDATE tickets SET staff_id = ? WHERE ticket_id = ?', (staff_id, ticket_id))
 
-def delete_ticket(ticket_id):
-    with ticket_db_lock:
-        ticket_cursor.execute('DELETE FROM tickets WHERE ticket_id = ?', (ticket_id,))
-        ticket_db.commit()
+async def delete_ticket(ticket_id):
+    await ticket_db.execute('DELETE FROM tickets WHERE ticket_id = ?', (ticket_id,))
 
 staff_ratings = defaultdict_ticket(list)
 CATEGORY_ID = 1397234544368685269
@@ -857,7 +1851,7 @@ class RatingButton(Button_ticket):
         self.rater_id = rater_id
     async def callback(self, interaction: discord_ticket.Interaction):
         if self.staff_id:
-            add_staff_rating(self.staff_id, self.rating)
+            await add_staff_rating(self.staff_id, self.rating)
             await interaction.response.send_message(f"\u2705 You rated {self.rating} stars!", ephemeral=True)
             log_channel = bot_ticket.get_channel(LOG_CHANNEL_ID)
             if log_channel:
@@ -868,7 +1862,7 @@ class RatingButton(Button_ticket):
             guild = interaction.guild
             staff_member = guild.get_member(self.staff_id)
             if staff_member and self.rating == 5:
-                if count_five_star_ratings(self.staff_id) == 15:
+                if await count_five_star_ratings(self.staff_id) == 15:
                     role = guild.get_role(PROMOTION_ROLE_ID)
                     if role and role not in staff_member.roles:
                         await staff_member.add_roles(role)
@@ -886,13 +1880,12 @@ async def handle_vouch_submit(interaction, staff_id, user_id, rating, descriptio
         f"Thank you for your vouch!\nStaff: <@{staff_id}>\nRating: {rating} stars\nDescription: {description}",
         ephemeral=True
     )
-    # Save the vouch to the database (thread-safe)
-    with vouch_db_lock:
-        vouch_cursor.execute(
-            'INSERT INTO vouches (staff_id, user_id, rating, description) VALUES (?, ?, ?, ?)',
-            (staff_id, user_id, rating, description)
-        )
-        ticket_db.commit()
+    # Save the vouch to the database
+    await ticket_db.execute(
+        'INSERT INTO vouches (staff_id, user_id, rating, description) VALUES (?, ?, ?, ?)',
+        (staff_id, user_id, rating, description)
+    )
+    bump_vouch_count(user_id)
     # Try to get the guild from the bot's cache (since interaction.guild may be None in DMs)
     guild = None
     for g in bot_ticket.guilds:
@@ -907,12 +1900,57 @@ async def handle_vouch_submit(interaction, staff_id, user_id, rating, descriptio
             f"📝 **Vouch Submitted**\nStaff: {staff.mention if staff else staff_id}\nFrom: {user.mention if user else user_id}\nRating: {rating} stars\nDescription: {description if description else 'No description.'}"
         )
 
-# --- Vouch Pagination View ---
-async def get_vouches_embed(ctx, user, page, per_page):
-    offset = (page - 1) * per_page
-    with vouch_db_lock:
-        total = vouch_cursor.execute('SELECT COUNT(*) FROM vouches WHERE user_id = ?', (user.id,)).fetchone()[0]
-        rows = vouch_cursor.execute('SELECT staff_id, rating, description, timestamp FROM vouches WHERE user_id = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?', (user.id, per_page, offset)).fetchall()
+# --- Vouch Pagination (keyset) ---
+# Pages are fetched relative to the (timestamp, id) of the first/last row on the
+# current page, so turning a page is an index seek no matter how deep it is.
+# Totals are counted once and then kept up to date as vouches are added.
+VOUCH_COLUMNS = 'id, staff_id, user_id, rating, description, timestamp'
+vouch_count_cache = {}  # user_id (None = all vouches) -> total
+
+async def get_vouch_count(user_id=None):
+    if user_id not in vouch_count_cache:
+        if user_id is None:
+            row = await ticket_db.fetchone('SELECT COUNT(*) FROM vouches')
+        else:
+            row = await ticket_db.fetchone('SELECT COUNT(*) FROM vouches WHERE user_id = ?', (user_id,))
+        vouch_count_cache[user_id] = row[0]
+    return vouch_count_cache[user_id]
+
+def bump_vouch_count(user_id):
+    for key in (user_id, None):
+        if key in vouch_count_cache:
+            vouch_count_cache[key] += 1
+
+async def fetch_vouch_page(user_id, per_page, after=None, before=None, offset=0):
+    # after/before are (timestamp, id) keys; rows always come back newest first
+    where = []
+    params = []
+    if user_id is not None:
+        where.append('user_id = ?')
+        params.append(user_id)
+    order = 'DESC'
+    if after is not None:
+        where.append('(timestamp, id) < (?, ?)')
+        params.extend(after)
+    elif before is not None:
+        where.append('(timestamp, id) > (?, ?)')
+        params.extend(before)
+        order = 'ASC'
+    sql = f'SELECT {VOUCH_COLUMNS} FROM vouches'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY timestamp {order}, id {order} LIMIT ?'
+    params.append(per_page)
+    if offset:
+        # Only used when a command jumps straight to a page number
+        sql += ' OFFSET ?'
+        params.append(offset)
+    rows = await ticket_db.fetchall(sql, params)
+    if order == 'ASC':
+        rows.reverse()
+    return rows
+
+def get_vouches_embed(ctx, user, rows, page, total, per_page):
     embed = discord_ticket.Embed(title=f"🌟 Vouches by {user.display_name}", color=discord_ticket.Color.blurple())
     for row in rows:
         staff_member = ctx.guild.get_member(row['staff_id'])
@@ -927,11 +1965,7 @@ async def get_vouches_embed(ctx, user, page, per_page):
     embed.set_footer(text=f"Page {page}/{total_pages} | Total vouches: {total}")
     return embed
 
-async def get_allvouches_embed(ctx, page, per_page):
-    offset = (page - 1) * per_page
-    with vouch_db_lock:
-        total = vouch_cursor.execute('SELECT COUNT(*) FROM vouches').fetchone()[0]
-        rows = vouch_cursor.execute('SELECT staff_id, user_id, rating, description, timestamp FROM vouches ORDER BY timestamp DESC LIMIT ? OFFSET ?', (per_page, offset)).fetchall()
+def get_allvouches_embed(ctx, rows, page, total, per_page):
     embed = discord_ticket.Embed(title="🌟 All Vouches", color=discord_ticket.Color.green())
     for row in rows:
         staff_member = ctx.guild.get_member(row['staff_id'])
@@ -953,28 +1987,26 @@ async def vouches(ctx, user: discord_ticket.Member = None, page: int = 1):
     user = user or ctx.author
     per_page = 10
     offset = (page - 1) * per_page
-    with vouch_db_lock:
-        total = vouch_cursor.execute('SELECT COUNT(*) FROM vouches WHERE user_id = ?', (user.id,)).fetchone()[0]
-        rows = vouch_cursor.execute('SELECT staff_id, rating, description, timestamp FROM vouches WHERE user_id = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?', (user.id, per_page, offset)).fetchall()
+    rows = await fetch_vouch_page(user.id, per_page, offset=offset)
     if not rows:
         await ctx.send(f"No vouches found for {user.mention} on page {page}.")
         return
-    embed = await get_vouches_embed(ctx, user, page, per_page)
-    view = VouchPaginationView(ctx, user=user, total=total, page=page, per_page=per_page, all_vouches=False)
+    total = await get_vouch_count(user.id)
+    embed = get_vouches_embed(ctx, user, rows, page, total, per_page)
+    view = VouchPaginationView(ctx, user=user, total=total, page=page, per_page=per_page, all_vouches=False, rows=rows)
     await ctx.send(embed=embed, view=view)
 
 @bot_ticket.command()
 async def allvouches(ctx, page: int = 1):
     per_page = 5
     offset = (page - 1) * per_page
-    with vouch_db_lock:
-        total = vouch_cursor.execute('SELECT COUNT(*) FROM vouches').fetchone()[0]
-        rows = vouch_cursor.execute('SELECT staff_id, user_id, rating, description, timestamp FROM vouches ORDER BY timestamp DESC LIMIT ? OFFSET ?', (per_page, offset)).fetchall()
+    rows = await fetch_vouch_page(None, per_page, offset=offset)
     if not rows:
         await ctx.send(f"No vouches found in the database on page {page}.")
         return
-    embed = await get_allvouches_embed(ctx, page, per_page)
-    view = VouchPaginationView(ctx, total=total, page=page, per_page=per_page, all_vouches=True)
+    total = await get_vouch_count()
+    embed = get_allvouches_embed(ctx, rows, page, total, per_page)
+    view = VouchPaginationView(ctx, total=total, page=page, per_page=per_page, all_vouches=True, rows=rows)
     await ctx.send(embed=embed, view=view)
 
 # --- Discord UI for Vouching ---
@@ -1067,15 +2099,15 @@ async def commandsdebug(ctx):
 # @bot_ticket.command(name="vouches") # This command is now handled by the new dio!vouches command
 # async def vouches(ctx, member: discord_ticket.Member = None):
 #     if member:
-#         rows = vouch_cursor.execute(
+#         rows = await ticket_db.fetchall(
 #             'SELECT * FROM vouches WHERE staff_id = ? ORDER BY timestamp DESC LIMIT 10',
 #             (member.id,)
-#         ).fetchall()
+#         )
 #         title = f"Vouches for {member.display_name}"
 #     else:
-#         rows = vouch_cursor.execute(
+#         rows = await ticket_db.fetchall(
 #             'SELECT * FROM vouches ORDER BY timestamp DESC LIMIT 10'
-#         ).fetchall()
+#         )
 #         title = "Recent Vouches"
 #     if not rows:
 #         await ctx.send("No vouches found.")
@@ -1098,7 +2130,7 @@ async def commandsdebug(ctx):
 
 # --- Persistent VouchPaginationView ---
 class VouchPaginationView(discord_ticket.ui.View):
-    def __init__(self, ctx, user=None, total=0, page=1, per_page=10, all_vouches=False):
+    def __init__(self, ctx, user=None, total=0, page=1, per_page=10, all_vouches=False, rows=None):
         super().__init__(timeout=None)
         self.ctx = ctx
         self.user = user
@@ -1107,8 +2139,14 @@ class VouchPaginationView(discord_ticket.ui.View):
         self.total = total
         self.all_vouches = all_vouches
         self.total_pages = (total + per_page - 1) // per_page
+        self.set_page_keys(rows or [])
         self.update_buttons()
 
+    def set_page_keys(self, rows):
+        # (timestamp, id) of the newest and oldest vouch on the page, used to seek the neighbours
+        self.first_key = (rows[0]['timestamp'], rows[0]['id']) if rows else None
+        self.last_key = (rows[-1]['timestamp'], rows[-1]['id']) if rows else None
+
     def update_buttons(self):
         self.clear_items()
         if self.page > 1:
@@ -1121,23 +2159,33 @@ class VouchPaginationView(discord_ticket.ui.View):
             super().__init__(label="Previous", style=discord_ticket.ButtonStyle.primary, custom_id="vouch_prev")
             self.parent = parent
         async def callback(self, interaction):
-            self.parent.page -= 1
-            await self.parent.update(interaction)
+            await self.parent.update(interaction, -1)
 
     class NextButton(discord_ticket.ui.Button):
         def __init__(self, parent):
             super().__init__(label="Next", style=discord_ticket.ButtonStyle.primary, custom_id="vouch_next")
             self.parent = parent
         async def callback(self, interaction):
-            self.parent.page += 1
-            await self.parent.update(interaction)
+            await self.parent.update(interaction, 1)
 
-    async def update(self, interaction):
+    async def update(self, interaction, direction):
+        user_id = None if self.all_vouches else self.user.id
+        if direction > 0:
+            rows = await fetch_vouch_page(user_id, self.per_page, after=self.last_key)
+        else:
+            rows = await fetch_vouch_page(user_id, self.per_page, before=self.first_key)
+        if not rows:
+            await interaction.response.send_message("No more vouches in that direction.", ephemeral=True)
+            return
+        self.page += direction
+        self.total = await get_vouch_count(user_id)
+        self.total_pages = (self.total + self.per_page - 1) // self.per_page
+        self.set_page_keys(rows)
         self.update_buttons()
         if self.all_vouches:
-            embed = await get_allvouches_embed(self.ctx, self.page, self.per_page)
+            embed = get_allvouches_embed(self.ctx, rows, self.page, self.total, self.per_page)
         else:
-            embed = await get_vouches_embed(self.ctx, self.user, self.page, self.per_page)
+            embed = get_vouches_embed(self.ctx, self.user, rows, self.page, self.total, self.per_page)
         await interaction.response.edit_message(embed=embed, view=self)
 
 # --- Persistent VouchView ---
@@ -1222,7 +2270,7 @@ class TicketTypeSelect(Select_ticket):
             helpers_role: discord_ticket.PermissionOverwrite(read_messages=True, send_messages=True)
         }
         ticket_channel = await guild.create_text_channel(ticket_name, overwrites=overwrites, category=category)
-        create_ticket(ticket_channel.id, interaction.user.id)
+        await create_ticket(ticket_channel.id, interaction.user.id)
         view = View_ticket()
         view.add_item(TakeRequestButton(interaction.user.id))
         view.add_item(DeleteTicketButton(interaction.user.id))
@@ -1244,9 +2292,11 @@ class TicketTypeSelect(Select_ticket):
         await ticket_channel.send(embed=help_embed)
         await ticket_channel.send(f"{interaction.user.mention} has opened a **{ticket_type.upper()}** support ticket!\n{staff_role.mention if staff_role else ''}", view=view)
         await interaction.response.send_message(f"\u2705 Your ticket has been created: {ticket_channel.mention}", ephemeral=True)
-        self.view.clear_items()
-        self.view.add_item(TicketTypeSelect())
-        await interaction.message.edit(view=self.view)
+        # clear_items() detaches this select from its view, so keep a reference first
+        view = self.view
+        view.clear_items()
+        view.add_item(TicketTypeSelect())
+        await interaction.message.edit(view=view)
 
 # --- Register all persistent views in on_ready ---
 @bot_ticket.event
@@ -1265,14 +2315,16 @@ async def ticketboard(ctx):
 
 @bot_ticket.command()
 async def staffratings(ctx):
-    if not get_staff_ratings(ctx.author.id):
+    rows = await get_staff_rating_summaries()
+    if not rows:
         await ctx.send("No ratings yet.")
         return
+    users = await ticket_names.resolve([row['staff_id'] for row in rows], ctx.guild)
     embed = discord_ticket.Embed(title="\u2b50 Staff Ratings", color=discord_ticket.Color.green())
-    for staff_id, ratings in get_staff_ratings(ctx.author.id):
-        user = await bot_ticket.fetch_user(staff_id)
-        avg = sum(ratings) / len(ratings)
-        embed.add_field(name=f"{user}", value=f"{len(ratings)} ratings | Avg: {avg:.2f}\u2b50", inline=False)
+    for row in rows:
+        user = users.get(row['staff_id'])
+        name = str(user) if user else f"ID:{row['staff_id']}"
+        embed.add_field(name=name, value=f"{row['count']} ratings | Avg: {row['avg']:.2f}\u2b50", inline=False)
     await ctx.send(embed=embed)
 
 def run_ticket_bot():
@@ -1284,7 +2336,7 @@ def run_ticket_bot():
 
 # ================== Music Bot ==================
 import discord as discord_music
-from discord.ext import commands as commands_music
+from discord.ext import commands as commands_music, tasks as tasks_music
 
 intents_music = discord_music.Intents.default()
 intents_music.message_content = True
@@ -1297,10 +2349,283 @@ guild_id = None  # Set your server's guild ID here for faster slash command regi
 # Add a global variable to track the current song info
 current_song = {}
 
+# --- Lazy music dependencies ---
+# yt_dlp is a large import and the voice checks spawn ffmpeg, so none of it runs
+# until the music bot logs in. The checks run concurrently and are timed.
+yt_dlp = None
+
+def import_yt_dlp():
+    global yt_dlp
+    if yt_dlp is None:
+        import yt_dlp as yt_dlp_module
+        yt_dlp = yt_dlp_module
+
+def check_pynacl():
+    try:
+        import nacl
+        print("✅ PyNaCl is installed")
+    except ImportError:
+        print("❌ PyNaCl is not installed. Please run: pip install PyNaCl")
+        print("Voice functionality will not work without PyNaCl.")
+        raise RuntimeError("PyNaCl is required for the music bot")
+
+async def check_ffmpeg():
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-version', stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+        returncode = await process.wait()
+    except FileNotFoundError:
+        returncode = None
+    if returncode == 0:
+        print("✅ FFmpeg is available")
+    else:
+        print("⚠️  FFmpeg not found. Voice functionality may not work properly.")
+        print("Please install FFmpeg: https://ffmpeg.org/download.html")
+
+async def timed_music_check(phase, check):
+    started = time.perf_counter()
+    await check
+    return phase, time.perf_counter() - started
+
+async def prepare_music_environment():
+    # Runs in the music bot's setup_hook, after the startup timing report has
+    # been printed, so the music phases get a report of their own
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    timings = await asyncio.gather(
+        timed_music_check("yt_dlp import", loop.run_in_executor(None, import_yt_dlp)),
+        timed_music_check("PyNaCl check", loop.run_in_executor(None, check_pynacl)),
+        timed_music_check("ffmpeg probe", check_ffmpeg()),
+    )
+    print(f"🎵 Music dependencies ready in {(time.perf_counter() - started) * 1000:.0f} ms")
+    for phase, seconds in timings:
+        print(f"   {phase}: {seconds * 1000:.0f} ms")
+
+bot_music.setup_hook = prepare_music_environment
+
+import random as random_music
+from collections import deque as deque_music
+import urllib.parse as urlparse_music
+import hashlib as hashlib_music
+import io as io_music
+import json as json_music
+from contextlib import contextmanager as contextmanager_music
+from discord.oggparse import OggStream as OggStream_music
+
 # Add rate limiting for YouTube requests
-import time
-last_youtube_request = 0
-YOUTUBE_RATE_LIMIT = 2  # Minimum seconds between requests
+# Each guild has its own token bucket and all guilds share a global one. When a
+# request has to wait it joins its guild's queue, and a scheduler hands out
+# tokens round-robin across guilds, so a guild spamming searches only delays
+# its own requests.
+YOUTUBE_GUILD_RATE = 0.5  # Requests per second per guild
+YOUTUBE_GUILD_BURST = 3
+YOUTUBE_GLOBAL_RATE = 2.0  # Requests per second across all guilds
+YOUTUBE_GLOBAL_BURST = 5
+RATE_LIMIT_SAMPLES = 500  # Recent wait times kept for the metrics
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # Seconds until one token is available
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class YouTubeRateLimiter:
+    def __init__(self, guild_rate=YOUTUBE_GUILD_RATE, guild_burst=YOUTUBE_GUILD_BURST,
+                 global_rate=YOUTUBE_GLOBAL_RATE, global_burst=YOUTUBE_GLOBAL_BURST):
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.buckets = {}
+        self.waiting = OrderedDict()  # guild_id -> deque of (future, enqueued_at), in round-robin order
+        self.scheduler = None
+        self.wakeup = None  # Created on first use, inside the music bot's loop
+        self.wait_times = deque_music(maxlen=RATE_LIMIT_SAMPLES)
+        self.granted = 0
+        self.delayed = 0
+
+    def bucket(self, guild_id):
+        if guild_id not in self.buckets:
+            self.buckets[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+        return self.buckets[guild_id]
+
+    async def acquire(self, guild_id):
+        now = time.monotonic()
+        bucket = self.bucket(guild_id)
+        # Anyone already queued goes first, so the fast path is only for an idle limiter
+        if not self.waiting and not bucket.delay(now) and not self.global_bucket.delay(now):
+            bucket.take()
+            self.global_bucket.take()
+            self.granted += 1
+            self.wait_times.append(0.0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(guild_id, deque_music()).append((future, now))
+        self.delayed += 1
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.scheduler is None or self.scheduler.done():
+            self.scheduler = asyncio.create_task(self._schedule())
+        else:
+            self.wakeup.set()  # A newly waiting guild may already have a token
+        await future
+
+    async def _sleep(self, delay):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _schedule(self):
+        while self.waiting:
+            now = time.monotonic()
+            global_delay = self.global_bucket.delay(now)
+            if global_delay:
+                await self._sleep(global_delay)
+                continue
+            # First guild in round-robin order whose own bucket has a token
+            next_delay = None
+            for guild_id in list(self.waiting):
+                waiters = self.waiting[guild_id]
+                while waiters and waiters[0][0].done():
+                    waiters.popleft()  # The command was cancelled
+                if not waiters:
+                    del self.waiting[guild_id]
+                    continue
+                delay = self.bucket(guild_id).delay(now)
+                if delay:
+                    next_delay = delay if next_delay is None else min(next_delay, delay)
+                    continue
+                future, enqueued_at = waiters.popleft()
+                self.bucket(guild_id).take()
+                self.global_bucket.take()
+                self.granted += 1
+                self.wait_times.append(now - enqueued_at)
+                future.set_result(None)
+                # Served guilds go to the back of the line
+                self.waiting.move_to_end(guild_id)
+                if not waiters:
+                    del self.waiting[guild_id]
+                break
+            else:
+                if next_delay is not None:
+                    await self._sleep(next_delay)
+
+    def queue_depth(self):
+        return sum(1 for waiters in self.waiting.values() for future, _ in waiters if not future.done())
+
+    def stats(self):
+        samples = sorted(self.wait_times)
+        def pct(p):
+            return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] if samples else 0.0
+        return {
+            'queue_depth': self.queue_depth(),
+            'waiting_guilds': len(self.waiting),
+            'deepest_guild': max((len(waiters) for waiters in self.waiting.values()), default=0),
+            'granted': self.granted,
+            'delayed': self.delayed,
+            'wait_p50': pct(50),
+            'wait_p95': pct(95),
+            'wait_max': samples[-1] if samples else 0.0,
+        }
+
+youtube_limiter = YouTubeRateLimiter()
+
+# --- Time-to-first-audio instrumentation ---
+# Each step between ?music-play and the first audio packet is timed as a named
+# phase and kept in a rolling window per phase. ?music-stats shows p50/p95;
+# the same numbers are available as JSON, and are written to MUSIC_STATS_FILE
+# every minute when that is set.
+MUSIC_STATS_SAMPLES = 500  # Most recent samples kept per phase
+MUSIC_STATS_FILE = os.getenv('MUSIC_STATS_FILE')
+MUSIC_PHASES = (
+    'voice connect', 'cache lookup', 'rate limit wait', 'search',
+    'stream extraction', 'source setup', 'first packet', 'time to first audio',
+)
+
+class MusicTimings:
+    def __init__(self, samples=MUSIC_STATS_SAMPLES):
+        self.samples = samples
+        self.phases = {}  # phase -> deque of milliseconds
+        self.errors = {}
+
+    def record(self, phase, seconds):
+        # deque.append is atomic, so the voice player thread may record too
+        if phase not in self.phases:
+            self.phases[phase] = deque_music(maxlen=self.samples)
+        self.phases[phase].append(seconds * 1000)
+
+    @contextmanager_music
+    def span(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.errors[phase] = self.errors.get(phase, 0) + 1
+            raise
+        finally:
+            self.record(phase, time.perf_counter() - started)
+
+    def summary(self):
+        result = {}
+        ordered = [phase for phase in MUSIC_PHASES if phase in self.phases]
+        ordered += sorted(phase for phase in self.phases if phase not in MUSIC_PHASES)
+        for phase in ordered:
+            samples = sorted(self.phases[phase])
+            if not samples:
+                continue
+            result[phase] = {
+                'count': len(samples),
+                'errors': self.errors.get(phase, 0),
+                'p50_ms': samples[min(len(samples) - 1, int(0.50 * len(samples)))],
+                'p95_ms': samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+                'max_ms': samples[-1],
+            }
+        return result
+
+    def export(self):
+        return json_music.dumps({'generated_at': time.time(), 'window': self.samples, 'phases': self.summary()}, indent=2)
+
+music_timings = MusicTimings()
+
+def time_first_packet(source, started_at=None):
+    # Wraps the source's read() for one call: the voice player thread reads the
+    # first packet as soon as playback really starts
+    original_read = source.read
+    play_started = time.perf_counter()
+
+    def read():
+        source.read = original_read
+        data = original_read()
+        now = time.perf_counter()
+        music_timings.record('first packet', now - play_started)
+        if started_at is not None:
+            music_timings.record('time to first audio', now - started_at)
+        return data
+
+    source.read = read
+
+@tasks_music.loop(seconds=60)
+async def export_music_stats():
+    try:
+        with open(MUSIC_STATS_FILE, 'w') as f:
+            f.write(music_timings.export())
+    except OSError as e:
+        print(f'Could not write music stats to {MUSIC_STATS_FILE}: {e}')
 
 @bot_music.event
 async def on_ready():
@@ -1310,10 +2635,950 @@ async def on_ready():
         print(f'Music Bot synced {len(synced)} command(s)')
     except Exception as e:
         print(f'Error syncing music bot commands: {e}')
+    if not reap_voice_sessions.is_running():
+        reap_voice_sessions.start()
+    if MUSIC_STATS_FILE and not export_music_stats.is_running():
+        export_music_stats.start()
+
+# --- Per-guild music queue ---
+# Each guild has a queue of Track objects. When a track finishes, the player's
+# after-callback advances the queue. About PREFETCH_LEAD seconds before the
+# current track ends, the next track's stream URL is extracted and its source
+# probed, so the next vc.play() starts with no search or probe delay.
+
+PREFETCH_LEAD = 30  # Seconds before the current track ends to prepare the next one
+QUEUE_DISPLAY_LIMIT = 10
+
+class Track:
+    def __init__(self, title, video_url, webpage_url, thumbnail, duration, requester):
+        self.title = title
+        self.video_url = video_url
+        self.webpage_url = webpage_url
+        self.thumbnail = thumbnail
+        self.duration = duration  # Seconds, or None when yt-dlp does not report it
+        self.requester = requester.display_name
+        self.requester_avatar = requester.display_avatar.url
+        self.source = None  # Prepared audio source, filled in by prefetch
+        self.prepare_task = None
+        self.requested_at = None  # perf_counter() of the ?music-play that starts this track right away
+
+    def discard_source(self):
+        # A prepared source holds a running ffmpeg process; release it if the track will not play next
+        if self.prepare_task:
+            if not self.prepare_task.done():
+                self.prepare_task.cancel()
+            elif not self.prepare_task.cancelled():
+                self.prepare_task.exception()  # Mark a failed prefetch as seen
+        self.prepare_task = None
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+class GuildMusicQueue:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.tracks = deque_music()
+        self.current = None
+        self.current_started = 0
+        self.text_channel = None
+        self.prefetch_task = None
+        self.prefetched = None  # Head track whose prefetch holds a stream slot
+        self.loaders = set()  # Background playlist enumerations feeding this queue
+        self.lock = asyncio.Lock()  # Held while a track is being started
+
+    def busy(self, vc):
+        return self.current is not None or self.lock.locked() or vc.is_playing() or vc.is_paused()
+
+    def add(self, track):
+        self.tracks.append(track)
+        self.schedule_prefetch()
+        return len(self.tracks)
+
+    def extend(self, tracks):
+        self.tracks.extend(tracks)
+        self.schedule_prefetch()
+
+    def remove(self, position):
+        track = self.tracks[position - 1]
+        del self.tracks[position - 1]
+        track.discard_source()
+        self.release_prefetch(track)
+        self.schedule_prefetch()
+        return track
+
+    def move(self, from_position, to_position):
+        track = self.tracks[from_position - 1]
+        del self.tracks[from_position - 1]
+        self.tracks.insert(to_position - 1, track)
+        self.reset_prepared()
+        return track
+
+    def shuffle(self):
+        tracks = list(self.tracks)
+        random_music.shuffle(tracks)
+        self.tracks = deque_music(tracks)
+        self.reset_prepared()
+
+    def clear(self):
+        for loader in self.loaders:
+            loader.cancel()
+        for track in self.tracks:
+            track.discard_source()
+        self.tracks.clear()
+        self.release_prefetch()
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        self.current = None
+
+    def reset_prepared(self):
+        # Only the head of the queue may hold a prepared source
+        for track in list(self.tracks)[1:]:
+            track.discard_source()
+            self.release_prefetch(track)
+        self.schedule_prefetch()
+
+    def schedule_prefetch(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        if not self.tracks or self.current is None:
+            return
+        delay = 0
+        if self.current.duration:
+            elapsed = time.monotonic() - self.current_started
+            delay = max(0, self.current.duration - elapsed - PREFETCH_LEAD)
+        self.prefetch_task = asyncio.create_task(self._prefetch_after(delay))
+
+    async def _prefetch_after(self, delay):
+        await asyncio.sleep(delay)
+        if not self.tracks:
+            return
+        track = self.tracks[0]
+        # The prefetched ffmpeg process runs next to the playing one, so it
+        # takes a stream slot of its own; with none free the track is prepared
+        # when it starts instead
+        if not voice_sessions.try_prefetch(self.guild_id):
+            return
+        self.prefetched = track
+        try:
+            source = await prepare_track(track, self.guild_id)
+        except Exception:
+            source = None  # Reported when the track is due to play
+        if not isinstance(source, discord_music.FFmpegAudio):
+            self.release_prefetch(track)  # Failed, or served from the Opus disk cache
+
+    def release_prefetch(self, track=None):
+        # Gives back the prefetch slot once its source is played or discarded
+        if self.prefetched is not None and (track is None or track is self.prefetched):
+            self.prefetched = None
+            voice_sessions.end_prefetch(self.guild_id)
+
+music_queues = {}
+
+def get_music_queue(guild_id):
+    if guild_id not in music_queues:
+        music_queues[guild_id] = GuildMusicQueue(guild_id)
+    return music_queues[guild_id]
+
+# --- Track resolution ---
+YTDL_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+FFMPEG_OPTIONS = {
+    'options': '-vn',
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+}
+
+# --- Extraction worker pool ---
+# yt-dlp calls block for seconds (network plus parsing), so they run on a
+# bounded thread pool and the music bot's loop only awaits them. Each call has
+# a timeout; a timed-out or cancelled call that has not started yet is dropped,
+# and one already running is cut short by socket_timeout. Every call is a
+# YouTube request, so each one first takes a token from the guild's and the
+# global rate limit.
+EXTRACTION_WORKERS = 8  # Room for one search race (4 strategies) plus prefetches
+EXTRACTION_TIMEOUT = 25  # Seconds before a command gives up on one extraction
+EXTRACTION_SOCKET_TIMEOUT = 10
+extraction_pool = concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix='yt-dlp')
+
+async def run_extraction(fn, *args, guild_id, timeout=EXTRACTION_TIMEOUT):
+    with music_timings.span('rate limit wait'):
+        await youtube_limiter.acquire(guild_id)
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(extraction_pool, fn, *args), timeout)
+
+YTDL_BASE_OPTIONS = {
+    # Opus audio (usually in WebM) can be passed to Discord without re-encoding
+    'format': 'bestaudio[acodec=opus]/bestaudio[ext=webm]/bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'ignoreerrors': True,
+    'no_check_certificate': True,
+    'prefer_insecure': True,
+    'socket_timeout': EXTRACTION_SOCKET_TIMEOUT,
+    'http_headers': YTDL_HEADERS
+}
+
+YTDL_OPTIONS = {
+    # Not flat: the search result is fully extracted, so the chosen audio
+    # format's stream URL comes back in the same pass
+    'search': {**YTDL_BASE_OPTIONS, 'noplaylist': True, 'default_search': 'ytsearch'},
+    'audio': YTDL_BASE_OPTIONS,
+    # Flat and lazy: entries are only url/title/duration stubs, and further
+    # pages are fetched only as the entries generator is consumed
+    'playlist': {**YTDL_BASE_OPTIONS, 'extract_flat': 'in_playlist', 'lazy_playlist': True},
+}
+
+# YoutubeDL objects are expensive to build (extractor registry, cookie jar) and
+# not thread-safe, so each pool thread keeps its own, one per option set
+ytdl_local = threading.local()
+
+def get_ytdl(kind):
+    instances = getattr(ytdl_local, 'instances', None)
+    if instances is None:
+        instances = ytdl_local.instances = {}
+    if kind not in instances:
+        instances[kind] = yt_dlp.YoutubeDL(YTDL_OPTIONS[kind])
+    return instances[kind]
+
+def first_result(info):
+    if not info:
+        raise RuntimeError('No results')
+    if 'entries' in info:
+        entries = [entry for entry in info['entries'] if entry]
+        if not entries:
+            raise RuntimeError('No results')
+        info = entries[0]
+    return info
+
+def extract_search_info(search_query):
+    return first_result(get_ytdl('search').extract_info(f'ytsearch1:{search_query}', download=False))
+
+def extract_url_info(video_url):
+    # A link is extracted as-is; noplaylist keeps a watch?list= link to one video
+    return first_result(get_ytdl('search').extract_info(video_url, download=False))
+
+def is_url(query):
+    parsed = urlparse_music.urlparse(query.strip())
+    return parsed.scheme in ('http', 'https') and bool(parsed.netloc)
+
+def extract_audio_info(video_url):
+    return get_ytdl('audio').extract_info(video_url, download=False)
+
+def open_playlist(playlist_url):
+    # A dedicated YoutubeDL: the entries generator keeps using it from whichever
+    # pool thread pulls the next batch, so it cannot be a thread-local one
+    ydl = yt_dlp.YoutubeDL(YTDL_OPTIONS['playlist'])
+    info = ydl.extract_info(playlist_url, download=False, process=False)
+    if info and info.get('_type') in ('url', 'url_transparent'):
+        info = ydl.extract_info(info['url'], download=False, process=False)
+    if not info or 'entries' not in info:
+        raise RuntimeError('Not a playlist')
+    return info.get('title') or 'playlist', iter(info['entries'])
+
+def take_playlist_entries(entries, count):
+    batch = []
+    for entry in entries:
+        if not entry or not entry.get('url') or entry.get('title') in ('[Private video]', '[Deleted video]'):
+            continue
+        batch.append(entry)
+        if len(batch) >= count:
+            break
+    return batch
+
+# --- Track resolution cache ---
+# Tier 1 maps a normalized query to video metadata: an in-memory LRU in front of
+# the track_cache table, so repeat searches skip yt-dlp even after a restart.
+# Tier 2 keeps the short-lived signed stream URLs in a bounded in-memory LRU,
+# until the expiry embedded in the URL (expire=...) minus the track length and
+# a margin. Links are cached as typed; only text queries are case-folded.
+
+TRACK_CACHE_SIZE = 500  # Queries kept in memory
+TRACK_CACHE_TTL = 30 * 24 * 3600  # Seconds before cached metadata is searched again
+AUDIO_URL_DEFAULT_TTL = 3600  # Used when a stream URL carries no expiry
+AUDIO_URL_SAFETY_MARGIN = 120
+
+music_db = AsyncDatabase('musicbot.db', schema=[
+    '''
+    CREATE TABLE IF NOT EXISTS track_cache (
+        query TEXT PRIMARY KEY,
+        video_id TEXT,
+        title TEXT NOT NULL,
+        thumbnail TEXT,
+        webpage_url TEXT NOT NULL,
+        duration INTEGER,
+        cached_at REAL NOT NULL
+    )
+    ''',
+])
+
+def normalize_query(query):
+    # Video IDs are case-sensitive, so links are only trimmed
+    if is_url(query):
+        return query.strip()
+    return ' '.join(query.lower().split())
+
+def track_metadata(info):
+    # In a full (non-flat) result 'url' is the audio stream, not the video page
+    webpage_url = info.get('webpage_url') or info['url']
+    return {
+        'video_id': info.get('id'),
+        'title': info.get('title', 'Unknown Title'),
+        'thumbnail': info.get('thumbnail', None),
+        'webpage_url': webpage_url,
+        'duration': info.get('duration'),
+    }
+
+def track_from_metadata(metadata, requester):
+    return Track(
+        title=metadata['title'],
+        video_url=metadata['webpage_url'],
+        webpage_url=metadata['webpage_url'],
+        thumbnail=metadata['thumbnail'],
+        duration=metadata['duration'],
+        requester=requester,
+    )
+
+def _store_track_metadata(conn, query, metadata, cached_at):
+    conn.execute(
+        'INSERT OR REPLACE INTO track_cache (query, video_id, title, thumbnail, webpage_url, duration, cached_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (query, metadata['video_id'], metadata['title'], metadata['thumbnail'], metadata['webpage_url'], metadata['duration'], cached_at)
+    )
+
+class TrackCache:
+    def __init__(self, db, size=TRACK_CACHE_SIZE, ttl=TRACK_CACHE_TTL):
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.memory = OrderedDict()  # normalized query -> (cached_at, metadata)
+        self.audio_streams = OrderedDict()  # webpage_url -> (stream, expires_at)
+
+    def _remember(self, key, cached_at, metadata):
+        self.memory[key] = (cached_at, metadata)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    async def get(self, query):
+        key = normalize_query(query)
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is None:
+            row = await self.db.fetchone(
+                'SELECT video_id, title, thumbnail, webpage_url, duration, cached_at FROM track_cache WHERE query = ?', (key,)
+            )
+            if row is None:
+                return None
+            entry = (row['cached_at'], {
+                'video_id': row['video_id'],
+                'title': row['title'],
+                'thumbnail': row['thumbnail'],
+                'webpage_url': row['webpage_url'],
+                'duration': row['duration'],
+            })
+        if now - entry[0] > self.ttl:
+            self.memory.pop(key, None)
+            return None
+        self._remember(key, *entry)
+        return entry[1]
+
+    def put(self, query, metadata):
+        key = normalize_query(query)
+        cached_at = time.time()
+        self._remember(key, cached_at, metadata)
+        # Written behind; the command does not wait for the commit
+        self.db.submit(_store_track_metadata, key, metadata, cached_at)
+
+    def get_audio_stream(self, webpage_url, duration=None):
+        entry = self.audio_streams.get(webpage_url)
+        if entry is None:
+            return None
+        stream, expires_at = entry
+        # The URL must outlive the whole track, since ffmpeg reconnects to it
+        if expires_at - time.time() < (duration or 0) + AUDIO_URL_SAFETY_MARGIN:
+            del self.audio_streams[webpage_url]
+            return None
+        self.audio_streams.move_to_end(webpage_url)
+        return stream
+
+    def put_audio_stream(self, webpage_url, stream):
+        self.audio_streams[webpage_url] = (stream, audio_url_expiry(stream['url']))
+        self.audio_streams.move_to_end(webpage_url)
+        while len(self.audio_streams) > self.size:
+            self.audio_streams.popitem(last=False)
+
+def audio_url_expiry(audio_url):
+    # googlevideo URLs carry their expiry as a unix timestamp, either as a query
+    # parameter (?expire=...) or as a path segment (/expire/...)
+    parsed = urlparse_music.urlparse(audio_url)
+    values = urlparse_music.parse_qs(parsed.query).get('expire')
+    if not values:
+        parts = parsed.path.split('/')
+        if 'expire' in parts and parts.index('expire') + 1 < len(parts):
+            values = [parts[parts.index('expire') + 1]]
+    try:
+        return float(values[0])
+    except (TypeError, ValueError, IndexError):
+        return time.time() + AUDIO_URL_DEFAULT_TTL
+
+track_cache = TrackCache(music_db)
+
+# --- On-disk Opus cache ---
+# Optional: set MUSIC_CACHE_DIR to keep played tracks as Ogg Opus files, so
+# replays read a local file instead of streaming and transcoding from YouTube.
+# A track is encoded in the background after its first play. Files are evicted
+# least recently played first once MUSIC_CACHE_MAX_BYTES is exceeded; file
+# mtimes record play order, so the LRU survives restarts.
+MUSIC_CACHE_DIR = os.getenv('MUSIC_CACHE_DIR')
+MUSIC_CACHE_MAX_BYTES = int(os.getenv('MUSIC_CACHE_MAX_BYTES', 1024 ** 3))
+MUSIC_CACHE_MAX_TRACK_SECONDS = 20 * 60  # Longer tracks (mixes, streams) are not cached
+MUSIC_CACHE_FILL_CONCURRENCY = 2
+
+class OpusFileSource(discord_music.AudioSource):
+    # Plays a cached Ogg Opus file directly: no ffmpeg process, no network
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.packets = OggStream_music(self.file).iter_packets()
+
+    def read(self):
+        for packet in self.packets:
+            if packet.startswith((b'OpusHead', b'OpusTags')):
+                continue  # Stream headers, not audio frames
+            return packet
+        return b''
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.file.close()
+
+class OpusDiskCache:
+    def __init__(self, directory, max_bytes=MUSIC_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> file size, least recently played first
+        self.total_bytes = 0
+        self.filling = set()
+        self.fill_semaphore = None
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)  # Left over from an interrupted fill
+            elif entry.name.endswith('.opus'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-len('.opus')], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def key(track):
+        return hashlib_music.sha1(track.webpage_url.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.opus')
+
+    def open(self, track):
+        key = self.key(track)
+        if key not in self.entries:
+            return None
+        path = self.path(key)
+        try:
+            source = OpusFileSource(path)
+            os.utime(path)
+        except OSError:
+            self.forget(key)
+            return None
+        self.entries.move_to_end(key)
+        return source
+
+    def forget(self, key):
+        self.total_bytes -= self.entries.pop(key, 0)
+
+    def schedule_fill(self, track, guild_id):
+        key = self.key(track)
+        if key in self.entries or key in self.filling:
+            return
+        if not track.duration or track.duration > MUSIC_CACHE_MAX_TRACK_SECONDS:
+            return
+        self.filling.add(key)
+        asyncio.create_task(self._fill(track, key, guild_id))
+
+    async def _fill(self, track, key, guild_id):
+        if self.fill_semaphore is None:
+            self.fill_semaphore = asyncio.Semaphore(MUSIC_CACHE_FILL_CONCURRENCY)
+        partial = self.path(key) + '.part'
+        try:
+            async with self.fill_semaphore:
+                stream = await extract_audio_stream(track.video_url, track.duration, guild_id)
+                # Opus sources are copied as-is; anything else is encoded once here
+                codec = ['-c:a', 'copy'] if stream['acodec'] == 'opus' else ['-c:a', 'libopus', '-ar', '48000', '-ac', '2', '-b:a', '128k']
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', *FFMPEG_OPTIONS['before_options'].split(), '-i', stream['url'],
+                    '-vn', '-map_metadata', '-1', *codec,
+                    '-f', 'opus', '-loglevel', 'error', '-y', partial,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+                )
+                try:
+                    returncode = await asyncio.wait_for(process.wait(), max(60, track.duration))
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                    raise RuntimeError('ffmpeg timed out')
+                if returncode != 0:
+                    raise RuntimeError(f'ffmpeg exited with {returncode}')
+            size = os.path.getsize(partial)
+            if size > self.max_bytes:
+                raise RuntimeError('track is larger than the cache budget')
+            os.replace(partial, self.path(key))
+            self.entries[key] = size
+            self.total_bytes += size
+            self.evict()
+        except Exception as e:
+            print(f'Opus cache fill failed for "{track.title}": {e}')
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+        finally:
+            self.filling.discard(key)
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))  # A reader that still has it open keeps its copy
+            except OSError:
+                pass
+
+opus_cache = OpusDiskCache(MUSIC_CACHE_DIR) if MUSIC_CACHE_DIR else None
+
+async def search_track(query, requester, guild_id=None):
+    with music_timings.span('cache lookup'):
+        metadata = await track_cache.get(query)
+    if metadata is not None:
+        return track_from_metadata(metadata, requester)
+    print(f"Searching: {query}")
+    if is_url(query):
+        # Links go straight to their extractor; only text is searched
+        with music_timings.span('search'):
+            info = await run_extraction(extract_url_info, query.strip(), guild_id=guild_id)
+    else:
+        # The plain query is preferred; the other strategies are fallbacks
+        search_strategies = [
+            query,  # Original query
+            f'"{query}"',  # Quoted query
+            query + ' official',  # Add "official" to search
+            query + ' music'  # Add "music" to search
+        ]
+        with music_timings.span('search'):
+            info = await race_extractions(extract_search_info, search_strategies, guild_id)
+    metadata = track_metadata(info)
+    track_cache.put(query, metadata)
+    if info.get('url') and info['url'] != metadata['webpage_url']:
+        # The search already picked the audio format; skip the second extraction
+        track_cache.put_audio_stream(metadata['webpage_url'], audio_stream(info))
+    return track_from_metadata(metadata, requester)
+
+# --- Playlists ---
+# The first batch of entries comes from the playlist's first page and starts
+# playing at once; a background loader pulls the rest in batches. Entries are
+# queued unresolved and get their stream URL from the prefetch just before
+# they play.
+PLAYLIST_BATCH = 50
+PLAYLIST_MAX_TRACKS = 500
+
+def is_playlist_url(query):
+    # Watch links with a list= parameter still play just that video
+    parsed = urlparse_music.urlparse(query.strip())
+    return parsed.netloc.endswith('youtube.com') and parsed.path == '/playlist'
+
+def track_from_entry(entry, requester):
+    thumbnails = entry.get('thumbnails') or []
+    return Track(
+        title=entry.get('title') or 'Unknown Title',
+        video_url=entry['url'],
+        webpage_url=entry['url'],
+        thumbnail=thumbnails[-1].get('url') if thumbnails else None,
+        duration=entry.get('duration'),
+        requester=requester,
+    )
+
+async def load_playlist_rest(music_queue, title, entries, requester, loaded):
+    try:
+        while loaded < PLAYLIST_MAX_TRACKS:
+            batch = await run_extraction(
+                take_playlist_entries, entries, min(PLAYLIST_BATCH, PLAYLIST_MAX_TRACKS - loaded), guild_id=music_queue.guild_id
+            )
+            if not batch:
+                break
+            music_queue.extend(track_from_entry(entry, requester) for entry in batch)
+            loaded += len(batch)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f'Stopped loading playlist "{title}": {e}')
+    if music_queue.text_channel:
+        await music_queue.text_channel.send(f'📜 Finished loading **{title}**: {loaded} song(s) queued.')
+
+async def queue_playlist(ctx, vc, playlist_url):
+    await ctx.send('📜 Loading playlist...')
+    try:
+        title, entries = await run_extraction(open_playlist, playlist_url, guild_id=ctx.guild.id)
+        batch = await run_extraction(take_playlist_entries, entries, PLAYLIST_BATCH, guild_id=ctx.guild.id)
+    except asyncio.TimeoutError:
+        await ctx.send(f'❌ Loading the playlist timed out after {EXTRACTION_TIMEOUT}s.')
+        return
+    except Exception as e:
+        await ctx.send(youtube_block_message(e, 'search') or f'❌ Could not load playlist: {e}')
+        return
+    if not batch:
+        await ctx.send('❌ That playlist has no playable songs.')
+        return
+
+    music_queue = get_music_queue(ctx.guild.id)
+    music_queue.text_channel = ctx.channel
+    busy = music_queue.busy(vc)
+    music_queue.extend(track_from_entry(entry, ctx.author) for entry in batch)
+    more = len(batch) == PLAYLIST_BATCH
+    await ctx.send(f'📜 Queued {len(batch)} song(s) from **{title}**' + (', loading the rest in the background.' if more else '.'))
+    if more:
+        loader = asyncio.create_task(load_playlist_rest(music_queue, title, entries, ctx.author, len(batch)))
+        music_queue.loaders.add(loader)
+        loader.add_done_callback(music_queue.loaders.discard)
+    if not busy:
+        await play_next(ctx.guild)
+
+SEARCH_HEDGE_DELAY = 4  # Seconds the first strategy runs alone before the fallbacks start
+
+async def race_extractions(fn, arguments, guild_id):
+    # Results are taken in priority order: a fallback's result is used only once
+    # every earlier argument has failed, so the same text always plays the same
+    # video. The fallbacks start when the first argument fails or is still
+    # running after SEARCH_HEDGE_DELAY, so a normal search is one request.
+    tasks = [asyncio.create_task(run_extraction(fn, arguments[0], guild_id=guild_id))]
+    last_error = None
+    try:
+        await asyncio.wait(tasks, timeout=SEARCH_HEDGE_DELAY)
+        if not tasks[0].done() or tasks[0].exception() is not None:
+            tasks += [asyncio.create_task(run_extraction(fn, argument, guild_id=guild_id)) for argument in arguments[1:]]
+        for task in tasks:
+            try:
+                return await task
+            except asyncio.TimeoutError:
+                last_error = RuntimeError(f'search timed out after {EXTRACTION_TIMEOUT}s')
+            except Exception as e:
+                last_error = e
+    finally:
+        # Fallbacks still queued in the pool are dropped; running ones finish in the background
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    raise last_error or RuntimeError('No results')
+
+def audio_stream(info):
+    # The chosen format's URL plus what yt-dlp knows about its encoding
+    acodec = info.get('acodec')
+    return {
+        'url': info['url'],
+        'acodec': acodec if acodec not in (None, 'none') else None,
+        'abr': info.get('abr'),
+    }
+
+async def extract_audio_stream(video_url, duration, guild_id):
+    stream = track_cache.get_audio_stream(video_url, duration)
+    if stream is not None:
+        return stream
+    try:
+        audio_info = await run_extraction(extract_audio_info, video_url, guild_id=guild_id)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f'audio extraction timed out after {EXTRACTION_TIMEOUT}s')
+    if not audio_info or 'url' not in audio_info:
+        raise RuntimeError('No playable audio stream found')
+    stream = audio_stream(audio_info)
+    track_cache.put_audio_stream(video_url, stream)
+    return stream
+
+async def create_audio_source(track, guild_id):
+    if opus_cache is not None:
+        source = opus_cache.open(track)
+        if source is not None:
+            return source
+    with music_timings.span('stream extraction'):
+        stream = await extract_audio_stream(track.video_url, track.duration, guild_id)
+    with music_timings.span('source setup'):
+        return await open_stream_source(stream)
+
+async def open_stream_source(stream):
+    if stream['acodec'] is None:
+        # Unknown encoding: let ffprobe work it out
+        return await discord_music.FFmpegOpusAudio.from_probe(stream['url'], **FFMPEG_OPTIONS)
+    if stream['acodec'] == 'opus':
+        # Already Opus: ffmpeg only remuxes the packets
+        return discord_music.FFmpegOpusAudio(stream['url'], codec='copy', bitrate=min(int(stream['abr'] or 128), 512), **FFMPEG_OPTIONS)
+    return discord_music.FFmpegOpusAudio(stream['url'], bitrate=128, **FFMPEG_OPTIONS)
+
+def prepare_track(track, guild_id):
+    # Starts (or reuses) preparation of the track's audio source
+    if track.source is None and (track.prepare_task is None or track.prepare_task.cancelled()):
+        track.prepare_task = asyncio.create_task(_prepare_track(track, guild_id))
+    return track.prepare_task
+
+async def _prepare_track(track, guild_id):
+    track.source = await create_audio_source(track, guild_id)
+    return track.source
+
+async def take_prepared_source(track, guild_id):
+    # Waits for prefetch if it is already running, otherwise prepares now
+    source = track.source
+    if source is None:
+        source = await prepare_track(track, guild_id)
+    track.source = None
+    track.prepare_task = None
+    return source
+
+def youtube_block_message(error, stage):
+    if "Sign in to confirm you're not a bot" in str(error):
+        if stage == 'search':
+            return '❌ YouTube is temporarily blocking automated access.\n\n**Solutions:**\n• Wait a few minutes and try again\n• Try a different search term\n• Use a YouTube link instead of search terms\n• Contact server staff if the issue persists'
+        return '❌ YouTube is temporarily blocking audio extraction.\n\n**Solutions:**\n• Wait a few minutes and try again\n• Try a different song\n• Use a YouTube link instead of search terms'
+    return None
+
+def now_playing_embed(track):
+    embed = discord_music.Embed(title='Now Playing', description=f'[{track.title}]({track.webpage_url})', color=0x1DB954)
+    if track.thumbnail:
+        embed.set_thumbnail(url=track.thumbnail)
+    embed.set_footer(text=f'Requested by {track.requester}', icon_url=track.requester_avatar)
+    return embed
+
+# --- Voice sessions ---
+# Every playing guild runs an ffmpeg child process (unless it plays from the
+# Opus disk cache), so the number of guilds streaming at once is capped. A guild
+# takes a stream slot when its queue starts and gives it back when the queue
+# runs dry; guilds beyond the cap wait in FIFO order. A prefetch that starts
+# ffmpeg for the next track early holds a second slot until that track plays,
+# and is skipped rather than queued when none is free. A reaper disconnects
+# voice clients that sit idle or alone in their channel.
+MUSIC_MAX_STREAMS = int(os.getenv('MUSIC_MAX_STREAMS', 10))
+MUSIC_IDLE_TIMEOUT = 300  # Seconds with nothing playing before leaving
+MUSIC_EMPTY_CHANNEL_TIMEOUT = 60  # Seconds alone in the channel before leaving
+VOICE_REAP_INTERVAL = 30
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+class VoiceSessionManager:
+    def __init__(self, max_streams=MUSIC_MAX_STREAMS):
+        self.max_streams = max_streams
+        self.streaming = set()  # Guild ids holding a stream slot
+        self.prefetching = set()  # Guild ids whose next track already runs ffmpeg
+        self.waiters = deque_music()  # (guild_id, future) in arrival order
+        self.idle_since = {}
+        self.empty_since = {}
+        self.cpu_samples = {}  # ffmpeg pid -> (cpu seconds, monotonic time)
+
+    def must_wait(self, guild_id):
+        return guild_id not in self.streaming and (self.in_use() >= self.max_streams or self.waiting_count() > 0)
+
+    def in_use(self):
+        return len(self.streaming) + len(self.prefetching)
+
+    def waiting_count(self):
+        return sum(1 for _, future in self.waiters if not future.done())
+
+    async def acquire(self, guild_id):
+        if not self.must_wait(guild_id):
+            self.streaming.add(guild_id)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((guild_id, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(guild_id)  # Granted just as the wait was cancelled
+            raise
+
+    def try_prefetch(self, guild_id):
+        # Never waits: prefetch only uses a slot no queued guild is asking for
+        if guild_id in self.prefetching:
+            return True
+        if self.in_use() >= self.max_streams or self.waiting_count() > 0:
+            return False
+        self.prefetching.add(guild_id)
+        return True
+
+    def end_prefetch(self, guild_id):
+        self.prefetching.discard(guild_id)
+        self.release(None)
+
+    def release(self, guild_id):
+        self.streaming.discard(guild_id)
+        while self.waiters and self.in_use() < self.max_streams:
+            waiter_id, future = self.waiters.popleft()
+            if not future.done():
+                self.streaming.add(waiter_id)
+                future.set_result(None)
+
+    def forget(self, guild_id):
+        self.prefetching.discard(guild_id)
+        self.release(guild_id)
+        self.idle_since.pop(guild_id, None)
+        self.empty_since.pop(guild_id, None)
+
+    def usage(self, vc):
+        # RSS and CPU of the ffmpeg process feeding this voice client, read from /proc
+        process = getattr(vc.source, '_process', None) if vc.source is not None else None
+        if process is None:
+            return None
+        try:
+            with open(f'/proc/{process.pid}/status') as f:
+                rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            with open(f'/proc/{process.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open('/proc/uptime') as f:
+                uptime = float(f.read().split()[0])
+        except (OSError, ValueError, StopIteration, IndexError):
+            return None
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        now = time.monotonic()
+        previous = self.cpu_samples.get(process.pid)
+        if previous and now > previous[1]:
+            cpu_percent = (cpu - previous[0]) / (now - previous[1]) * 100
+        else:
+            age = uptime - int(fields[19]) / CLOCK_TICKS
+            cpu_percent = cpu / age * 100 if age > 0 else 0.0
+        self.cpu_samples[process.pid] = (cpu, now)
+        return {'pid': process.pid, 'rss_mb': rss_kb / 1024, 'cpu_percent': cpu_percent}
+
+voice_sessions = VoiceSessionManager()
+
+async def end_voice_session(guild, vc, reason):
+    music_queue = get_music_queue(guild.id)
+    # Clear first so the after-callback of the stopped song finds nothing to play
+    music_queue.clear()
+    current_song.pop(guild.id, None)
+    voice_sessions.forget(guild.id)
+    await vc.disconnect()
+    if music_queue.text_channel:
+        await music_queue.text_channel.send(f'👋 Left the voice channel: {reason}.')
+
+@tasks_music.loop(seconds=VOICE_REAP_INTERVAL)
+async def reap_voice_sessions():
+    now = time.monotonic()
+    connected = set()
+    live_pids = set()
+    for vc in list(bot_music.voice_clients):
+        guild = vc.guild
+        connected.add(guild.id)
+        usage = voice_sessions.usage(vc)
+        if usage:
+            live_pids.add(usage['pid'])
+        if any(not member.bot for member in vc.channel.members):
+            voice_sessions.empty_since.pop(guild.id, None)
+        else:
+            voice_sessions.empty_since.setdefault(guild.id, now)
+        music_queue = get_music_queue(guild.id)
+        if vc.is_playing() or music_queue.tracks or music_queue.lock.locked():
+            voice_sessions.idle_since.pop(guild.id, None)
+        else:
+            voice_sessions.idle_since.setdefault(guild.id, now)
+        if now - voice_sessions.empty_since.get(guild.id, now) >= MUSIC_EMPTY_CHANNEL_TIMEOUT:
+            reason = 'everyone left the channel'
+        elif now - voice_sessions.idle_since.get(guild.id, now) >= MUSIC_IDLE_TIMEOUT:
+            reason = f'nothing played for {MUSIC_IDLE_TIMEOUT // 60} minutes'
+        else:
+            continue
+        try:
+            await end_voice_session(guild, vc, reason)
+        except Exception as e:
+            print(f'Error leaving idle voice channel in guild {guild.id}: {e}')
+    for state in (voice_sessions.idle_since, voice_sessions.empty_since):
+        for stale in [guild_id for guild_id in state if guild_id not in connected]:
+            del state[stale]
+    for pid in [pid for pid in voice_sessions.cpu_samples if pid not in live_pids]:
+        del voice_sessions.cpu_samples[pid]
+
+@reap_voice_sessions.before_loop
+async def before_reap_voice_sessions():
+    await bot_music.wait_until_ready()
+
+# --- Playback ---
+async def play_next(guild):
+    music_queue = get_music_queue(guild.id)
+    async with music_queue.lock:
+        await _play_next(guild, music_queue)
+
+async def _play_next(guild, music_queue):
+    # Pops tracks until one starts playing or the queue is empty
+    vc = guild.voice_client
+    if vc is not None and (vc.is_playing() or vc.is_paused()):
+        return
+    while music_queue.tracks:
+        if vc is None or not vc.is_connected():
+            music_queue.clear()
+            break
+        if voice_sessions.must_wait(guild.id):
+            if music_queue.text_channel:
+                await music_queue.text_channel.send(
+                    f'⏳ All {voice_sessions.max_streams} music streams are busy; '
+                    f'you are number {voice_sessions.waiting_count() + 1} in line.'
+                )
+        await voice_sessions.acquire(guild.id)
+        if not music_queue.tracks or not vc.is_connected():
+            continue  # Stopped or disconnected while waiting
+        track = music_queue.tracks.popleft()
+        try:
+            source = await take_prepared_source(track, guild.id)
+        except Exception as e:
+            music_queue.release_prefetch(track)
+            if music_queue.text_channel:
+                message = youtube_block_message(e, 'audio')
+                await music_queue.text_channel.send(message or f'❌ Could not play "{track.title}": {e}')
+            continue
+        # The guild's own slot now covers this source's ffmpeg process
+        music_queue.release_prefetch(track)
+        try:
+            time_first_packet(source, track.requested_at)
+            vc.play(source, after=lambda error, guild=guild: on_track_end(guild, error))
+        except Exception as e:
+            source.cleanup()
+            if music_queue.text_channel:
+                await music_queue.text_channel.send(f'❌ Error playing audio: {e}')
+            continue
+        music_queue.current = track
+        music_queue.current_started = time.monotonic()
+        # Track current song info
+        current_song[guild.id] = {
+            'title': track.title,
+            'webpage_url': track.webpage_url,
+            'thumbnail': track.thumbnail,
+            'requester': track.requester,
+            'requester_avatar': track.requester_avatar
+        }
+        music_queue.schedule_prefetch()
+        if opus_cache is not None and not isinstance(source, OpusFileSource):
+            opus_cache.schedule_fill(track, guild.id)
+        if music_queue.text_channel:
+            await music_queue.text_channel.send(embed=now_playing_embed(track))
+        return
+    music_queue.current = None
+    current_song.pop(guild.id, None)
+    voice_sessions.release(guild.id)
+
+def on_track_end(guild, error):
+    # Called from the voice player thread
+    if error:
+        print(f'Music player error in guild {guild.id}: {error}')
+    asyncio.run_coroutine_threadsafe(play_next(guild), bot_music.loop)
 
 @bot_music.command(name='music-play', help='Play music by title or YouTube link')
 async def music_play(ctx, *, query: str):
-    global current_song
+    started = time.perf_counter()
     user = ctx.author
     voice_state = user.voice
     if not voice_state or not voice_state.channel:
@@ -1334,7 +3599,8 @@ async def music_play(ctx, *, query: str):
     # Connect to voice channel if not already connected
     if ctx.voice_client is None:
         try:
-            vc = await channel.connect(timeout=20.0)
+            with music_timings.span('voice connect'):
+                vc = await channel.connect(timeout=20.0)
         except Exception as e:
             await ctx.send(f'❌ Could not join voice channel: {e}')
             return
@@ -1342,144 +3608,58 @@ async def music_play(ctx, *, query: str):
         vc = ctx.voice_client
         if vc.channel != channel:
             try:
-                await vc.move_to(channel)
+                with music_timings.span('voice connect'):
+                    await vc.move_to(channel)
             except Exception as e:
                 await ctx.send(f'❌ Could not move to voice channel: {e}')
                 return
 
-    # Rate limiting
-    global last_youtube_request
-    current_time = time.time()
-    if current_time - last_youtube_request < YOUTUBE_RATE_LIMIT:
-        await asyncio.sleep(YOUTUBE_RATE_LIMIT - (current_time - last_youtube_request))
-    last_youtube_request = time.time()
-    
-    await ctx.send(f'🔍 Searching for: {query}')
-
-    # Try multiple search strategies
-    search_strategies = [
-        query,  # Original query
-        f'"{query}"',  # Quoted query
-        query + ' official',  # Add "official" to search
-        query + ' music'  # Add "music" to search
-    ]
-    
-    search_opts = {
-        'format': 'bestaudio/best',
-        'noplaylist': True,
-        'default_search': 'ytsearch',
-        'quiet': True,
-        'extract_flat': 'True',
-        'no_warnings': True,
-        'ignoreerrors': True,
-        'no_check_certificate': True,
-        'prefer_insecure': True,
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-    }
-    
-    info = None
-    last_error = None
-    
-    for search_query in search_strategies:
-        print(f"Trying search: {search_query}")
-        with yt_dlp.YoutubeDL(search_opts) as ydl:
-            try:
-                info = ydl.extract_info(search_query, download=False)
-                if 'entries' in info:
-                    info = info['entries'][0]
-                video_url = info['url'] if 'url' in info else info['webpage_url']
-                title = info.get('title', 'Unknown Title')
-                webpage_url = info.get('webpage_url', video_url)
-                thumbnail = info.get('thumbnail', None)
-                break  # Success, exit the loop
-            except Exception as e:
-                last_error = e
-                await asyncio.sleep(0.5)  # Small delay between attempts
-                continue  # Try next strategy
-    
-    if info is None:
-        error_msg = str(last_error)
-        if "Sign in to confirm you're not a bot" in error_msg:
-            await ctx.send(f'❌ YouTube is temporarily blocking automated access.\n\n**Solutions:**\n• Wait a few minutes and try again\n• Try a different search term\n• Use a YouTube link instead of search terms\n• Contact server staff if the issue persists')
-        else:
-            await ctx.send(f'❌ Could not find or play "{query}": {last_error}')
+    if is_playlist_url(query):
+        await queue_playlist(ctx, vc, query)
         return
 
-    audio_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'no_warnings': True,
-        'ignoreerrors': True,
-        'no_check_certificate': True,
-        'prefer_insecure': True,
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-    }
-    with yt_dlp.YoutubeDL(audio_opts) as ydl:
-        try:
-            audio_info = ydl.extract_info(video_url, download=False)
-            audio_url = audio_info['url']
-        except Exception as e:
-            error_msg = str(e)
-            if "Sign in to confirm you're not a bot" in error_msg:
-                await ctx.send(f'❌ YouTube is temporarily blocking audio extraction.\n\n**Solutions:**\n• Wait a few minutes and try again\n• Try a different song\n• Use a YouTube link instead of search terms')
-            else:
-                await ctx.send(f'❌ Could not extract audio: {e}')
-            return
+    await ctx.send(f'🔍 Searching for: {query}')
 
-    ffmpeg_options = {
-        'options': '-vn',
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-    }
     try:
-        audio_source = await discord_music.FFmpegOpusAudio.from_probe(audio_url, **ffmpeg_options)
+        track = await search_track(query, user, ctx.guild.id)
     except Exception as e:
-        await ctx.send(f'❌ Error preparing audio: {e}')
+        await ctx.send(youtube_block_message(e, 'search') or f'❌ Could not find or play "{query}": {e}')
         return
 
-    try:
-        if vc.is_playing():
-            vc.stop()
-        vc.play(audio_source)
-    except Exception as e:
-        await ctx.send(f'❌ Error playing audio: {e}')
+    music_queue = get_music_queue(ctx.guild.id)
+    music_queue.text_channel = ctx.channel
+    busy = music_queue.busy(vc)
+    if not busy:
+        track.requested_at = started  # Queued tracks would only time the queue
+    position = music_queue.add(track)
+    if busy:
+        await ctx.send(f'➕ Added to queue at position {position}: **{track.title}**')
         return
-
-    # Track current song info
-    current_song[ctx.guild.id] = {
-        'title': title,
-        'webpage_url': webpage_url,
-        'thumbnail': thumbnail,
-        'requester': user.display_name,
-        'requester_avatar': user.display_avatar.url
-    }
-
-    embed = discord_music.Embed(title='Now Playing', description=f'[{title}]({webpage_url})', color=0x1DB954)
-    if thumbnail:
-        embed.set_thumbnail(url=thumbnail)
-    embed.set_footer(text=f'Requested by {user.display_name}', icon_url=user.display_avatar.url)
-    await ctx.send(embed=embed)
+    await play_next(ctx.guild)
 
 @bot_music.command(name='music-help', help='Show help for music commands')
 async def music_help(ctx):
     embed = discord_music.Embed(title='Music Bot Help', color=0x1DB954)
-    embed.add_field(name='?music-play [title or link]', value='Play a song by title or link.', inline=False)
+    embed.add_field(name='?music-play [title or link]', value='Play a song by title, link or playlist link, or add it to the queue.', inline=False)
     embed.add_field(name='?music-skip', value='Skip the current song.', inline=False)
     embed.add_field(name='?music-pause', value='Pause the current song.', inline=False)
     embed.add_field(name='?music-resume', value='Resume playback.', inline=False)
     embed.add_field(name='?music-stop', value='Stop playback and clear the queue.', inline=False)
     embed.add_field(name='?music-nowplaying', value='Show info about the currently playing song.', inline=False)
+    embed.add_field(name='?music-queue', value='Show the upcoming songs.', inline=False)
+    embed.add_field(name='?music-remove [position]', value='Remove a song from the queue.', inline=False)
+    embed.add_field(name='?music-move [from] [to]', value='Move a song to another queue position.', inline=False)
+    embed.add_field(name='?music-shuffle', value='Shuffle the queue.', inline=False)
+    embed.add_field(name='?music-stats [json]', value='Show how long each step of ?music-play takes.', inline=False)
+    embed.add_field(name='?music-ratelimit', value='Show YouTube rate limiter queue depth and wait times.', inline=False)
     embed.set_footer(text='Use ?music-play to get started!')
     await ctx.send(embed=embed)
 
 @bot_music.command(name='music-skip', help='Skip the current song.')
 async def music_skip(ctx):
     vc = ctx.voice_client
-    if vc and vc.is_playing():
-        vc.stop()
+    if vc and (vc.is_playing() or vc.is_paused()):
+        vc.stop()  # The after-callback starts the next queued song
         await ctx.send('⏭️ Skipped the current song.')
     else:
         await ctx.send('❌ No song is currently playing.')
@@ -1506,6 +3686,9 @@ async def music_resume(ctx):
 async def music_stop(ctx):
     vc = ctx.voice_client
     if vc:
+        # Clear first so the after-callback of the stopped song finds nothing to play
+        get_music_queue(ctx.guild.id).clear()
+        voice_sessions.forget(ctx.guild.id)
         await vc.disconnect()
         current_song.pop(ctx.guild.id, None)
         await ctx.send('⏹️ Stopped playback and disconnected.')
@@ -1524,6 +3707,103 @@ async def music_nowplaying(ctx):
     else:
         await ctx.send('❌ No song is currently playing.')
 
+@bot_music.command(name='music-queue', help='Show the upcoming songs.')
+async def music_queue_list(ctx):
+    music_queue = get_music_queue(ctx.guild.id)
+    if not music_queue.tracks:
+        await ctx.send('📭 The queue is empty.')
+        return
+    lines = []
+    for position, track in enumerate(list(music_queue.tracks)[:QUEUE_DISPLAY_LIMIT], start=1):
+        lines.append(f'**{position}.** [{track.title}]({track.webpage_url}) — {track.requester}')
+    embed = discord_music.Embed(title='Music Queue', description='\n'.join(lines), color=0x1DB954)
+    if music_queue.current:
+        embed.add_field(name='Now Playing', value=f'[{music_queue.current.title}]({music_queue.current.webpage_url})', inline=False)
+    hidden = len(music_queue.tracks) - QUEUE_DISPLAY_LIMIT
+    embed.set_footer(text=f'{len(music_queue.tracks)} song(s) queued' + (f' ({hidden} more not shown)' if hidden > 0 else ''))
+    await ctx.send(embed=embed)
+
+@bot_music.command(name='music-remove', help='Remove a song from the queue.')
+async def music_remove(ctx, position: int):
+    music_queue = get_music_queue(ctx.guild.id)
+    if not 1 <= position <= len(music_queue.tracks):
+        await ctx.send(f'❌ Position must be between 1 and {len(music_queue.tracks)}.')
+        return
+    track = music_queue.remove(position)
+    await ctx.send(f'🗑️ Removed **{track.title}** from the queue.')
+
+@bot_music.command(name='music-move', help='Move a song to another queue position.')
+async def music_move(ctx, from_position: int, to_position: int):
+    music_queue = get_music_queue(ctx.guild.id)
+    size = len(music_queue.tracks)
+    if not (1 <= from_position <= size and 1 <= to_position <= size):
+        await ctx.send(f'❌ Positions must be between 1 and {size}.')
+        return
+    track = music_queue.move(from_position, to_position)
+    await ctx.send(f'↕️ Moved **{track.title}** to position {to_position}.')
+
+@bot_music.command(name='music-ratelimit', help='Show YouTube rate limiter queue depth and wait times.')
+async def music_ratelimit(ctx):
+    stats = youtube_limiter.stats()
+    embed = discord_music.Embed(title='YouTube Rate Limiter', color=0x1DB954)
+    embed.add_field(name='Queued requests', value=f"{stats['queue_depth']} across {stats['waiting_guilds']} server(s)", inline=False)
+    embed.add_field(name='This server', value=f"{len(youtube_limiter.waiting.get(ctx.guild.id, ()))} queued", inline=False)
+    embed.add_field(name='Wait time', value=f"p50 {stats['wait_p50']:.2f}s · p95 {stats['wait_p95']:.2f}s · max {stats['wait_max']:.2f}s", inline=False)
+    embed.set_footer(text=f"{stats['granted']} requests granted, {stats['delayed']} had to wait")
+    await ctx.send(embed=embed)
+
+@bot_music.command(name='music-sessions', help='Show voice sessions and their ffmpeg resource use.')
+@commands_music.is_owner()
+async def music_sessions(ctx):
+    embed = discord_music.Embed(
+        title='Voice Sessions',
+        description=f'{voice_sessions.in_use()}/{voice_sessions.max_streams} streams in use, {voice_sessions.waiting_count()} server(s) waiting',
+        color=0x1DB954
+    )
+    for vc in list(bot_music.voice_clients)[:25]:
+        music_queue = get_music_queue(vc.guild.id)
+        state = 'playing' if vc.is_playing() else 'paused' if vc.is_paused() else 'idle'
+        usage = voice_sessions.usage(vc)
+        if usage:
+            resources = f"ffmpeg {usage['pid']}: {usage['rss_mb']:.1f} MB RSS, {usage['cpu_percent']:.1f}% CPU"
+        elif isinstance(vc.source, OpusFileSource):
+            resources = 'cached file, no ffmpeg'
+        else:
+            resources = 'no stream'
+        embed.add_field(
+            name=vc.guild.name,
+            value=f'#{vc.channel.name} · {state} · {len(music_queue.tracks)} queued\n{resources}',
+            inline=False
+        )
+    await ctx.send(embed=embed)
+
+@bot_music.command(name='music-stats', help='Show how long each step of ?music-play takes.')
+async def music_stats(ctx, export: str = None):
+    if export == 'json':
+        await ctx.send(file=discord_music.File(io_music.BytesIO(music_timings.export().encode()), filename='music-stats.json'))
+        return
+    summary = music_timings.summary()
+    if not summary:
+        await ctx.send('📭 No timings recorded yet.')
+        return
+    lines = [
+        f"**{phase}**: p50 {stats['p50_ms']:.0f} ms · p95 {stats['p95_ms']:.0f} ms ({stats['count']} samples"
+        + (f", {stats['errors']} failed)" if stats['errors'] else ')')
+        for phase, stats in summary.items()
+    ]
+    embed = discord_music.Embed(title='Music Timings', description='\n'.join(lines), color=0x1DB954)
+    embed.set_footer(text=f'Last {music_timings.samples} samples per step · ?music-stats json to export')
+    await ctx.send(embed=embed)
+
+@bot_music.command(name='music-shuffle', help='Shuffle the queue.')
+async def music_shuffle(ctx):
+    music_queue = get_music_queue(ctx.guild.id)
+    if len(music_queue.tracks) < 2:
+        await ctx.send('❌ Not enough songs in the queue to shuffle.')
+        return
+    music_queue.shuffle()
+    await ctx.send('🔀 Shuffled the queue.')
+
 def run_music_bot():
     try:
         print("🎵 Starting Music Bot...")
@@ -1531,11 +3811,246 @@ def run_music_bot():
     except Exception as e:
         print(f"❌ Music Bot failed to start: {e}")
 
+phase_started = record_startup_phase("bot definitions", phase_started)
+
+# ================== Single-Loop Orchestrator ==================
+import aiohttp
+
+# Every bot with the env var holding its token, used by the non-thread modes
+bot_registry = [
+    ("Application Bot", bot_app, "APP_BOT_TOKEN"),
+    ("Giveaway Bot", bot_give, "GIVEAWAY_BOT_TOKEN"),
+    ("Invites Bot", bot_inv, "INVITES_BOT_TOKEN"),
+    ("Ticket Bot", bot_ticket, "TICKET_BOT_TOKEN"),
+    ("Music Bot", bot_music, "MUSIC_BOT_TOKEN"),
+]
+
+def track_ready_time(name, bot):
+    # Reports how long after launch each gateway session first became ready
+    reported = False
+    async def report_ready():
+        nonlocal reported
+        if not reported:
+            reported = True
+            print(f"⏱️ {name} ready {time.perf_counter() - startup_started:.2f}s after launch")
+    bot.add_listener(report_ready, 'on_ready')
+
+for registered_name, registered_bot, _ in bot_registry:
+    track_ready_time(registered_name, registered_bot)
+
+class SharedConnector(aiohttp.TCPConnector):
+    # discord.py creates each bot's ClientSession with the default
+    # connector_owner=True, so a bot closing (on shutdown, or inside connect()
+    # after a fatal gateway close such as a bad token) would close the
+    # connector under the other four. Closing through a session is therefore a
+    # no-op; only the orchestrator releases it, with shutdown().
+    def close(self, *, abort_ssl=False):
+        done = self._loop.create_future()
+        done.set_result(None)
+        return done
+
+    def shutdown(self):
+        return super().close()
+
+async def start_bot_on_shared_loop(name, bot, token, connector):
+    # Hand the bot our connector before login so its HTTP session pools sockets with the others
+    bot.http.connector = connector
+    try:
+        print(f"🚀 Starting {name} on the shared loop...")
+        await bot.start(token)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"❌ {name} failed to start: {e}")
+
+async def run_all_bots_single_loop():
+    # One loop, one connector: all five gateway sessions and REST clients share them
+    connector = SharedConnector(limit=0)
+    tasks = [
+        asyncio.create_task(start_bot_on_shared_loop(name, bot, os.environ[token_env], connector), name=name)
+        for name, bot, token_env in bot_registry
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Shut down as a unit: stop every bot, then release the shared connector
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(bot.close() for _, bot, _ in bot_registry), return_exceptions=True)
+        await connector.shutdown()
+        print("🛑 All bots disconnected")
+
+# ================== Supervised Multi-Process Orchestrator ==================
+import multiprocessing
+import time
+
+HEARTBEAT_INTERVAL = 5  # Seconds between heartbeats sent by each bot process
+HEARTBEAT_TIMEOUT = 60  # A process whose loop has not beaten for this long is restarted
+RESTART_BACKOFF_BASE = 1  # First restart delay in seconds, doubled on each consecutive crash
+RESTART_BACKOFF_MAX = 300
+STABLE_UPTIME = 600  # Seconds of healthy running after which the backoff resets
+STOP_GRACE_PERIOD = 15  # Seconds a process gets to close its bot and drain buffers before SIGTERM
+
+def get_registered_bot(name):
+    for bot_name, bot, token_env in bot_registry:
+        if bot_name == name:
+            return bot, token_env
+    raise KeyError(name)
+
+async def send_heartbeats(heartbeat):
+    # Runs on the bot's own loop, so a blocked loop stops the heartbeat too
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+async def watch_stop_request(bot, stop_event):
+    # The supervisor asks for a clean stop; closing the bot lets bot.start()
+    # return normally, so the process exits through its atexit drains
+    while not stop_event.is_set():
+        await asyncio.sleep(0.5)
+    await bot.close()
+
+async def run_bot_in_process(name, heartbeat, stop_event):
+    bot, token_env = get_registered_bot(name)
+    heartbeat_task = asyncio.create_task(send_heartbeats(heartbeat))
+    stop_task = asyncio.create_task(watch_stop_request(bot, stop_event))
+    try:
+        async with bot:
+            await bot.start(os.environ[token_env])
+    finally:
+        heartbeat_task.cancel()
+        stop_task.cancel()
+
+def bot_process_main(name, heartbeat, stop_event):
+    try:
+        asyncio.run(run_bot_in_process(name, heartbeat, stop_event))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"❌ {name} crashed: {e}")
+        sys.exit(1)
+
+class BotSupervisor:
+    def __init__(self, name, mp_context):
+        self.name = name
+        self.mp_context = mp_context
+        self.process = None
+        self.heartbeat = None
+        self.stop_event = None
+        self.started_at = 0
+        self.restart_at = 0
+        self.crashes = 0
+        self.consecutive_crashes = 0
+
+    def start(self):
+        self.heartbeat = self.mp_context.Value('d', time.time())
+        self.stop_event = self.mp_context.Event()
+        self.process = self.mp_context.Process(
+            target=bot_process_main, args=(self.name, self.heartbeat, self.stop_event), name=self.name, daemon=True
+        )
+        self.process.start()
+        self.started_at = time.time()
+        print(f"✅ {self.name} process started (pid {self.process.pid})")
+
+    def request_stop(self):
+        if self.process and self.process.is_alive():
+            self.stop_event.set()
+
+    def stop(self, grace=STOP_GRACE_PERIOD, timeout=10):
+        # Polite first: the child closes its bot and drains its buffers.
+        # SIGTERM and then SIGKILL only if it does not exit in time.
+        if not (self.process and self.process.is_alive()):
+            return
+        self.request_stop()
+        self.process.join(grace)
+        if self.process.is_alive():
+            print(f"⚠️ {self.name} did not stop within {grace}s, terminating")
+            self.process.terminate()
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def record_crash(self, reason):
+        self.crashes += 1
+        if time.time() - self.started_at >= STABLE_UPTIME:
+            self.consecutive_crashes = 0
+        self.consecutive_crashes += 1
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** (self.consecutive_crashes - 1))
+        self.restart_at = time.time() + delay
+        self.process = None
+        print(f"❌ {self.name} {reason} (crash #{self.crashes}), restarting in {delay}s")
+
+    def poll(self):
+        now = time.time()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        if not self.process.is_alive():
+            self.record_crash(f"exited with code {self.process.exitcode}")
+        elif now - self.heartbeat.value > HEARTBEAT_TIMEOUT:
+            self.stop()
+            self.record_crash(f"missed heartbeats for {int(now - self.heartbeat.value)}s")
+
+def run_all_bots_multiprocess():
+    # spawn keeps children clear of the parent's sqlite handles and threads
+    mp_context = multiprocessing.get_context("spawn")
+    supervisors = [BotSupervisor(name, mp_context) for name, _, _ in bot_registry]
+    try:
+        while True:
+            for supervisor in supervisors:
+                supervisor.poll()
+            time.sleep(1)
+    finally:
+        # Children may already be handling the same Ctrl+C; ask all of them
+        # at once, then wait on each, so the grace periods overlap
+        for supervisor in supervisors:
+            supervisor.request_stop()
+        for supervisor in supervisors:
+            supervisor.stop()
+        print("🛑 All bot processes stopped")
+        for supervisor in supervisors:
+            print(f"   {supervisor.name}: {supervisor.crashes} crash(es)")
+
 # ================== Start All Bots ==================
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run all Discord bots")
+    parser.add_argument(
+        "--mode",
+        choices=["threads", "single-loop", "multiprocess"],
+        default=os.getenv("ORCHESTRATOR_MODE", "threads"),
+        help=(
+            "threads: one thread and event loop per bot; single-loop: all bots on one shared event loop; "
+            "multiprocess: one supervised process per bot with restarts"
+        ),
+    )
+    args = parser.parse_args()
+
     print("🤖 Starting Discord Bot Orchestrator...")
+    print_startup_timings()
     print("=" * 50)
-    
+
+    if args.mode == "single-loop":
+        print("🔁 Running all bots on one shared event loop")
+        print("Press Ctrl+C to stop all bots")
+        try:
+            asyncio.run(run_all_bots_single_loop())
+        except KeyboardInterrupt:
+            print("\n🛑 Shutting down bots...")
+        sys.exit(0)
+
+    if args.mode == "multiprocess":
+        print("🧩 Running each bot in its own supervised process")
+        print("Press Ctrl+C to stop all bots")
+        try:
+            run_all_bots_multiprocess()
+        except KeyboardInterrupt:
+            print("\n🛑 Shutting down bots...")
+        sys.exit(0)
+
     # Start bots with error handling
     threads = []
     bot_functions = [
@@ -0,0 +1,279 @@
+# Offline benchmarks for the bots' hot handlers.
+#
+# Runs the real handlers from all_bots.py against stubbed discord.py objects and
+# throwaway SQLite files in a temporary directory, so nothing connects to Discord.
+# Reports throughput, p50/p99 latency and writer-thread database time per op.
+#
+#   python bench_bots.py                    # default run
+#   python bench_bots.py -n 5000 -c 50      # more iterations, more concurrency
+#   python bench_bots.py --only on_message  # a single benchmark
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_bots(workdir):
+    # all_bots creates its databases in the working directory at import time
+    os.chdir(workdir)
+    for token in ("APP_BOT_TOKEN", "GIVEAWAY_BOT_TOKEN", "INVITES_BOT_TOKEN", "TICKET_BOT_TOKEN", "MUSIC_BOT_TOKEN"):
+        os.environ.setdefault(token, "offline-benchmark")
+    sys.path.insert(0, REPO_DIR)
+    import all_bots
+    return all_bots
+
+
+# --- Stubbed discord.py objects ---
+ACCOUNT_CREATED = datetime(2020, 1, 1, tzinfo=timezone.utc)  # Old enough not to count as a fake invite
+
+
+async def noop(*args, **kwargs):
+    # Stands in for REST calls (send, edit, delete); cheaper than AsyncMock so it stays out of the numbers
+    return None
+
+
+def make_channel(channel_id):
+    return SimpleNamespace(id=channel_id, mention=f"<#{channel_id}>", send=noop, delete=noop)
+
+
+class StubUser:
+    # A class rather than a SimpleNamespace so it can key permission overwrites
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+        self.display_name = self.name = f"user{user_id}"
+
+
+def make_user(user_id, bot=False):
+    return StubUser(user_id, bot)
+
+
+def make_message(user_id, channel):
+    return SimpleNamespace(author=make_user(user_id), channel=channel, content="hello")
+
+
+def make_invite(code, uses, inviter_id):
+    return SimpleNamespace(code=code, uses=uses, max_uses=0, inviter=make_user(inviter_id))
+
+
+class StubGuild:
+    def __init__(self, guild_id, invite_count=50):
+        self.id = guild_id
+        self.vanity_url_code = None
+        self.default_role = "default_role"
+        self.invites_list = [make_invite(f"code{i}", 0, 1000 + i) for i in range(invite_count)]
+        self.next_channel_id = 10_000
+        self.invite_fetches = 0
+
+    def use_invite(self, index):
+        self.invites_list[index].uses += 1
+
+    async def invites(self):
+        self.invite_fetches += 1
+        return [make_invite(invite.code, invite.uses, invite.inviter.id) for invite in self.invites_list]
+
+    async def vanity_invite(self):
+        return None
+
+    def get_channel(self, channel_id):
+        return None
+
+    def get_role(self, role_id):
+        return None
+
+    def get_member(self, member_id):
+        return None
+
+    async def create_text_channel(self, name, overwrites=None, category=None, **kwargs):
+        self.next_channel_id += 1
+        return make_channel(self.next_channel_id)
+
+
+def make_interaction(user_id, guild):
+    return SimpleNamespace(
+        user=make_user(user_id),
+        guild=guild,
+        channel=make_channel(1),
+        message=SimpleNamespace(edit=noop),
+        response=SimpleNamespace(send_message=noop, edit_message=noop),
+    )
+
+
+# --- Measurement ---
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def measure(bots, name, op, iterations, concurrency, finish=None):
+    # Runs op(i) for i in range(iterations), `concurrency` at a time
+    db_busy_before = sum(db.busy_seconds for db in bots.all_databases)
+    latencies = []
+
+    async def timed(i):
+        started = time.perf_counter()
+        await op(i)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for batch_start in range(0, iterations, concurrency):
+        await asyncio.gather(*(timed(i) for i in range(batch_start, min(iterations, batch_start + concurrency))))
+    if finish is not None:
+        await finish()
+    # Let the writer threads settle so their busy time is counted
+    await asyncio.gather(*(db.run(lambda conn: None) for db in bots.all_databases))
+    elapsed = time.perf_counter() - started
+    db_busy = sum(db.busy_seconds for db in bots.all_databases) - db_busy_before
+    return {
+        "name": name,
+        "ops": iterations,
+        "ops_per_sec": iterations / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "db_ms_per_op": db_busy / iterations * 1000,
+    }
+
+
+# --- Benchmarks ---
+# Event handlers are read off their bot (bot_give.on_message, ...) because
+# several bots define module-level functions with the same event name.
+async def bench_on_message(bots, iterations, concurrency):
+    channel = make_channel(1)
+    bots.bot_give.process_commands = noop
+    users = max(1, iterations // 20)
+
+    async def op(i):
+        await bots.bot_give.on_message(make_message(500_000 + i % users, channel))
+
+    return await measure(bots, "on_message (EXP)", op, iterations, concurrency, finish=bots.exp_buffer.flush)
+
+
+async def bench_member_join(bots, iterations, concurrency):
+    guild = StubGuild(1)
+    # A short debounce so latency reflects the diff work, not the batching window
+    engine = bots.invite_engines[guild.id] = bots.InviteDiffEngine(guild.id, debounce=0.01)
+    await engine.refresh(guild)
+    fetches_before = guild.invite_fetches
+
+    async def op(i):
+        guild.use_invite(i % len(guild.invites_list))
+        await bots.bot_inv.on_member_join(SimpleNamespace(id=900_000 + i, guild=guild, bot=False, created_at=ACCOUNT_CREATED))
+
+    # Concurrent joins model a join burst; they share invite snapshots
+    result = await measure(bots, "on_member_join (invite diff)", op, iterations, concurrency)
+    stats = engine.stats()
+    print(f"   on_member_join: {guild.invite_fetches - fetches_before} invite fetches for {iterations} joins, "
+          f"mean confidence {stats['mean_confidence']:.0%}, {stats['unattributed']} unattributed")
+    return result
+
+
+async def bench_ticket_select(bots, iterations, concurrency):
+    guild = StubGuild(2)
+    view = bots.TicketBoardView()
+
+    async def op(i):
+        select = view.children[0]
+        select._values = ["ALS" if i % 2 else "ASTDX"]
+        await select.callback(make_interaction(700_000 + i, guild))
+
+    return await measure(bots, "TicketTypeSelect.callback", op, iterations, 1)
+
+
+async def bench_vouch_submit(bots, iterations, concurrency):
+    async def op(i):
+        interaction = make_interaction(800_000 + i % 100, None)
+        await bots.handle_vouch_submit(interaction, 600_000 + i % 10, 800_000 + i % 100, 1 + i % 5, "great help")
+
+    return await measure(bots, "handle_vouch_submit", op, iterations, concurrency)
+
+
+async def bench_storage_helpers(bots, iterations, concurrency):
+    results = []
+
+    async def set_exp(i):
+        await bots.set_user_exp(i % 1000, i % 3, 1 + i % 7)
+    results.append(await measure(bots, "set_user_exp", set_exp, iterations, concurrency))
+
+    async def get_exp(i):
+        await bots.get_user_exp(i % 1000)
+    results.append(await measure(bots, "get_user_exp", get_exp, iterations, concurrency))
+
+    async def app_number(i):
+        await bots.increment_app_counter(("astdx", "als", "all")[i % 3])
+    results.append(await measure(bots, "increment_app_counter", app_number, iterations, concurrency))
+
+    async def add_points(i):
+        await bots.add_invite_points(i % 200, 1)
+    results.append(await measure(bots, "add_invite_points", add_points, iterations, concurrency))
+
+    async def member_leave(i):
+        await bots.record_invite_leave(1, 900_000 + i)
+    results.append(await measure(bots, "record_invite_leave", member_leave, iterations, concurrency))
+
+    async def ticket_round_trip(i):
+        await bots.create_ticket(i, 1)
+        await bots.get_ticket(i)
+    results.append(await measure(bots, "create_ticket + get_ticket", ticket_round_trip, iterations, concurrency))
+
+    async def vouch_page(i):
+        await bots.fetch_vouch_page(800_000 + i % 100, 10)
+    results.append(await measure(bots, "fetch_vouch_page", vouch_page, iterations, concurrency))
+
+    async def user_rank(i):
+        await bots.get_user_rank(i % 1000)
+    results.append(await measure(bots, "get_user_rank", user_rank, iterations, concurrency))
+    return results
+
+
+BENCHMARKS = {
+    "on_message": bench_on_message,
+    "on_member_join": bench_member_join,
+    "ticket_select": bench_ticket_select,
+    "vouch_submit": bench_vouch_submit,
+    "storage": bench_storage_helpers,
+}
+
+
+def print_results(results):
+    header = f"{'benchmark':<32} {'ops':>7} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'db ms/op':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['name']:<32} {r['ops']:>7} {r['ops_per_sec']:>10.0f} {r['p50_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['db_ms_per_op']:>9.3f}")
+
+
+async def run(bots, names, iterations, concurrency):
+    results = []
+    for name in names:
+        outcome = await BENCHMARKS[name](bots, iterations, concurrency)
+        results.extend(outcome if isinstance(outcome, list) else [outcome])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the bots' hot handlers")
+    parser.add_argument("-n", "--iterations", type=int, default=1000, help="operations per benchmark")
+    parser.add_argument("-c", "--concurrency", type=int, default=20, help="operations in flight at once")
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append", help="run only these benchmarks")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bots-bench-") as workdir:
+        bots = load_bots(workdir)
+        print(f"📊 Benchmarking in {workdir} ({args.iterations} ops, concurrency {args.concurrency})")
+        results = asyncio.run(run(bots, args.only or list(BENCHMARKS), args.iterations, args.concurrency))
+        print_results(results)
+        bots.exp_buffer.drain()
+        bots.close_all_databases()
+        os.chdir(REPO_DIR)
+
+
+if __name__ == "__main__":
+    main()